@@ -1,18 +1,30 @@
 # Hito 3: Creación y Contextualización de Chunks Hijo (Nuevo PDF - Corregido)
 # --------------------------------------------------------------------------
 # Objetivo: Cargar, segmentar, dividir en chunks y contextualizar el nuevo PDF,
-#           guardando el resultado en un archivo JSON.
+#           guardando el resultado en un archivo JSON Lines (un chunk por línea).
+#           La contextualización hace varias peticiones a Ollama a la vez, reintenta con espera
+#           exponencial y guarda cada contexto generado en una caché persistente: si el proceso se
+#           interrumpe o se vuelve a lanzar, no se repite el trabajo ya hecho.
 # Librerías necesarias:
 # pip install langchain-community langchain-ollama tiktoken
 
+import hashlib
+import json
 import os
+import random
 import re
-import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from langchain_community.document_loaders import PyMuPDFLoader
 from langchain_ollama import ChatOllama
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import ChatPromptTemplate
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from graph.chunk_io import write_chunk_line
+
 # --- Funciones de Carga y Segmentación (Hitos 1 y 2) ---
 
 def load_financial_report(file_path: str) -> list:
@@ -77,50 +89,143 @@ Aquí está el chunk que queremos situar dentro del documento completo:
 Por favor, proporciona un contexto breve y conciso en una sola frase para situar este chunk dentro del documento general. El objetivo es mejorar la recuperación en búsquedas. Responde únicamente con la frase de contexto y nada más.
 """
 
-def create_and_contextualize_chunks(parent_docs: list, llm: ChatOllama):
+# --- Configuración de la contextualización ---
+CONTEXTUALIZE_CONCURRENCY = 4  # Peticiones simultáneas a Ollama (ajustar a OLLAMA_NUM_PARALLEL del servidor)
+CONTEXTUALIZE_MAX_RETRIES = 4  # Reintentos por chunk antes de darlo por fallido
+CONTEXTUALIZE_RETRY_BASE_DELAY = 2.0  # Segundos de la primera espera; se duplica en cada reintento
+CONTEXTUALIZE_CACHE_FILE = "contextualize_cache.jsonl"
+
+def _text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+class ContextCache:
+    """
+    Caché persistente de contextos generados, con clave (modelo, hash del documento padre, hash del chunk).
+    Es un fichero JSON Lines al que solo se añaden líneas (una por contexto, escrita en cuanto se genera);
+    una última línea a medias por una interrupción se descarta al cargar.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._contexts = {}
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                data = f.read()
+            complete = data[:data.rfind(b"\n") + 1]
+            if len(complete) != len(data):
+                os.truncate(filename, len(complete))
+            for line in complete.decode("utf-8").splitlines():
+                entry = json.loads(line)
+                self._contexts[(entry["model"], entry["parent_hash"], entry["chunk_hash"])] = entry["generated_context"]
+        self._lock = threading.Lock()
+        self._file = open(filename, "a", encoding="utf-8")
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    @staticmethod
+    def key(model: str, parent_doc_text: str, chunk: str) -> tuple:
+        return model, _text_hash(parent_doc_text), _text_hash(chunk)
+
+    def get(self, key: tuple):
+        return self._contexts.get(key)
+
+    def put(self, key: tuple, generated_context: str):
+        model, parent_hash, chunk_hash = key
+        with self._lock:
+            self._contexts[key] = generated_context
+            write_chunk_line(self._file, {"model": model, "parent_hash": parent_hash,
+                                          "chunk_hash": chunk_hash, "generated_context": generated_context})
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def contextualize_with_retry(contextualize_chain, parent_doc_text: str, chunk: str) -> str:
+    """Pide el contexto al LLM; si falla (timeout, Ollama saturado...) reintenta con espera exponencial y jitter."""
+    for attempt in range(CONTEXTUALIZE_MAX_RETRIES + 1):
+        try:
+            response = contextualize_chain.invoke({"parent_document": parent_doc_text, "child_chunk": chunk})
+            return response.content.strip()
+        except Exception as e:
+            if attempt == CONTEXTUALIZE_MAX_RETRIES:
+                raise
+            delay = CONTEXTUALIZE_RETRY_BASE_DELAY * 2 ** attempt * random.uniform(1.0, 1.5)
+            print(f"    Reintento {attempt + 1}/{CONTEXTUALIZE_MAX_RETRIES} en {delay:.1f}s tras error: {e}")
+            time.sleep(delay)
+
+def create_and_contextualize_chunks(parent_docs: list, llm: ChatOllama, model_name: str,
+                                    cache: ContextCache, output_filename: str) -> tuple:
+    """
+    Contextualiza todos los chunks hijo con CONTEXTUALIZE_CONCURRENCY peticiones en paralelo y los va
+    escribiendo (en el orden del documento) en cuanto están listos. Devuelve (chunks escritos, chunks con error).
+    """
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=512, chunk_overlap=64)
     contextualize_prompt = ChatPromptTemplate.from_template(CONTEXTUALIZE_PROMPT_TEMPLATE)
     contextualize_chain = contextualize_prompt | llm
-    all_contextualized_chunks = []
-
-    print("\nIniciando creación y contextualización de chunks hijo con Ollama...")
-    for i, parent_doc_text in enumerate(parent_docs):
-        print(f"Procesando Documento Padre #{i+1}/{len(parent_docs)}...")
-        child_chunks = text_splitter.split_text(parent_doc_text)
-        for j, chunk in enumerate(child_chunks):
-            print(f"  - Contextualizando chunk hijo #{j+1}/{len(child_chunks)}...")
+
+    # COMENTARIO: Los trabajos van documento a documento: las peticiones simultáneas comparten el mismo
+    # prefijo (el documento padre va al principio del prompt), que Ollama puede reutilizar entre llamadas.
+    jobs = [(i, parent_doc_text, chunk)
+            for i, parent_doc_text in enumerate(parent_docs)
+            for chunk in text_splitter.split_text(parent_doc_text)]
+    cached = sum(1 for i, parent_doc_text, chunk in jobs
+                 if cache.get(cache.key(model_name, parent_doc_text, chunk)) is not None)
+    print(f"\nIniciando contextualización de {len(jobs)} chunks hijo con Ollama "
+          f"({cached} ya en la caché, {CONTEXTUALIZE_CONCURRENCY} peticiones simultáneas)...")
+
+    def contextualize(job):
+        i, parent_doc_text, chunk = job
+        key = cache.key(model_name, parent_doc_text, chunk)
+        generated_context = cache.get(key)
+        if generated_context is None:
             try:
-                response = contextualize_chain.invoke({"parent_document": parent_doc_text, "child_chunk": chunk})
-                generated_context = response.content.strip()
-                contextualized_chunk = f"{generated_context}\n\n{chunk}"
-                all_contextualized_chunks.append({
-                    "parent_doc_index": i,
-                    "original_chunk": chunk,
-                    "generated_context": generated_context,
-                    "contextualized_chunk": contextualized_chunk
-                })
+                generated_context = contextualize_with_retry(contextualize_chain, parent_doc_text, chunk)
             except Exception as e:
-                print(f"    ERROR al contextualizar chunk: {e}")
-                continue
-    
-    print(f"\n¡Proceso de contextualización completado! Se han creado {len(all_contextualized_chunks)} chunks.")
-    return all_contextualized_chunks
-
-def save_chunks_to_json(chunks: list, filename: str):
-    print(f"\nGuardando {len(chunks)} chunks en el archivo '{filename}'...")
-    try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(chunks, f, indent=4, ensure_ascii=False)
-        print("¡Guardado completado con éxito!")
-    except Exception as e:
-        print(f"Error al guardar el archivo JSON: {e}")
+                print(f"    ERROR al contextualizar chunk del Documento Padre #{i+1}: {e}")
+                return None
+            cache.put(key, generated_context)
+        return {
+            "parent_doc_index": i,
+            "original_chunk": chunk,
+            "generated_context": generated_context,
+            "contextualized_chunk": f"{generated_context}\n\n{chunk}"
+        }
+
+    # COMENTARIO: Se escribe en un fichero '.partial' que solo sustituye al de salida si todos los chunks
+    # se contextualizaron, para que la ingesta nunca lea un corpus a medias (que borraría de Qdrant,
+    # del almacén y del índice BM25 los chunks que faltan).
+    partial_filename = f"{output_filename}.partial"
+    written = failed = 0
+    start_time = time.time()
+    with open(partial_filename, "w", encoding="utf-8") as f, \
+            ThreadPoolExecutor(max_workers=CONTEXTUALIZE_CONCURRENCY) as pool:
+        # pool.map devuelve los resultados en el orden de los trabajos
+        for position, contextualized in enumerate(pool.map(contextualize, jobs), start=1):
+            if contextualized is None:
+                failed += 1
+            else:
+                write_chunk_line(f, contextualized)
+                f.flush()
+                written += 1
+            if position % 50 == 0 or position == len(jobs):
+                elapsed = time.time() - start_time
+                print(f"  - {position}/{len(jobs)} chunks procesados en {elapsed:.1f}s ({failed} con error)")
+    if failed:
+        print(f"\n{failed} chunks no se pudieron contextualizar. Se conserva '{partial_filename}' y no se "
+              f"modifica '{output_filename}'; vuelve a lanzar el proceso para reintentarlos (lo ya hecho sale de la caché).")
+        return written, failed
+    os.replace(partial_filename, output_filename)
+
+    print(f"\n¡Proceso de contextualización completado! Se han creado {written} chunks.")
+    return written, failed
 
 if __name__ == "__main__":
     # --- CONFIGURACIÓN ---
     # --- CORRECCIÓN: Añadir una 'r' antes de las comillas para crear un "raw string" ---
     pdf_file_path = r"bd_pdf\PLAN_GENERAL_DE_CONTABILIDAD.pdf" # <-- LÍNEA CORREGIDA
     CONTENT_START_PAGE = 8 # Página donde termina el sumario
-    output_filename = "pgc_contextualized_chunks.json" # Nuevo nombre de archivo
+    output_filename = "pgc_contextualized_chunks.jsonl" # Nuevo nombre de archivo (JSON Lines)
 
     # Configuración de Ollama
     ollama_base_url = "http://10.1.0.176:11434"
@@ -141,13 +246,19 @@ if __name__ == "__main__":
         print(f"Conectando a Ollama en {ollama_base_url} con el modelo {ollama_model}...")
         llm = ChatOllama(base_url=ollama_base_url, model=ollama_model, temperature=0)
 
-        # 3. Crear y contextualizar los chunks
+        # 3. Crear y contextualizar los chunks, guardándolos en el archivo JSON Lines a medida que se generan
         print("\n--- PASO 3: Creando y Contextualizando Chunks ---")
-        final_chunks = create_and_contextualize_chunks(parent_documents, llm)
+        context_cache = ContextCache(CONTEXTUALIZE_CACHE_FILE)
+        print(f"Caché de contextos '{CONTEXTUALIZE_CACHE_FILE}' con {len(context_cache)} entradas.")
+        try:
+            written_chunks, failed_chunks = create_and_contextualize_chunks(parent_documents, llm, ollama_model,
+                                                                            context_cache, output_filename)
+        finally:
+            context_cache.close()
 
-        # 4. Guardar el resultado en un archivo JSON
-        if final_chunks:
-            save_chunks_to_json(final_chunks, output_filename)
+        if failed_chunks:
+            sys.exit(1)
+        if written_chunks:
             print(f"\nProceso finalizado. Los chunks están guardados en '{output_filename}'.")
     else:
         print("No se crearon documentos padre. El proceso se detiene.")
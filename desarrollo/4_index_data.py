@@ -6,17 +6,22 @@
 # Librerías necesarias:
 # pip install qdrant-client langchain-ollama rank_bm25 numpy
 
-import json
 import os
 import pickle
+import sys
+from itertools import chain, islice
 from qdrant_client import QdrantClient, models
 # --- CAMBIO 1: Importar desde el nuevo paquete ---
 from langchain_ollama import OllamaEmbeddings
 from rank_bm25 import BM25Okapi
 import numpy as np
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from graph.chunk_io import iter_chunks
+from graph.document_embedding_cache import CachedDocumentEmbeddings, MmapEmbeddingStore
+
 # --- CONFIGURACIÓN ---
-# Archivo de entrada con los chunks procesados
+# Archivo de entrada con los chunks procesados (JSON Lines o array JSON)
 INPUT_JSON_FILE = "contextualized_chunks.json"
 
 # Configuración de Qdrant
@@ -29,35 +34,23 @@ OLLAMA_BASE_URL = "http://10.1.0.176:11434"
 OLLAMA_EMBEDDING_MODEL = "nomic-embed-text:latest" 
 # La dimensión del vector para nomic-embed-text es 768
 VECTOR_DIMENSION = 768
+# Caché en disco de embeddings (la misma que usa ingest.py): reindexar sin cambios no llama a Ollama
+EMBEDDING_CACHE_DIR = "embedding_cache"
 
 # Archivo de salida para el índice BM25
 BM25_INDEX_FILE = "bm25_index.pkl"
 
-def load_chunks_from_json(filename: str) -> list:
-    """Carga los chunks desde el archivo JSON de salida del hito anterior."""
-    print(f"Cargando chunks desde '{filename}'...")
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            chunks = json.load(f)
-        print(f"Se han cargado {len(chunks)} chunks.")
-        return chunks
-    except FileNotFoundError:
-        print(f"Error: No se encontró el archivo '{filename}'. Asegúrate de que existe.")
-        return []
-    except Exception as e:
-        print(f"Error al cargar el archivo JSON: {e}")
-        return []
+def iter_tokenized(chunks, tokenized_corpus: list):
+    """Deja pasar los chunks guardando su texto tokenizado para BM25 (no se guarda el texto completo)."""
+    for chunk in chunks:
+        # El tokenizador simple divide por espacios en blanco. Es suficiente para empezar.
+        tokenized_corpus.append(chunk['contextualized_chunk'].split(" "))
+        yield chunk
 
-def create_bm25_index(chunks: list):
-    """Crea y guarda un índice BM25 a partir de los chunks."""
+def create_bm25_index(tokenized_corpus: list):
+    """Crea y guarda un índice BM25 a partir del corpus tokenizado."""
     print("\nIniciando creación del índice BM25...")
     
-    # Extraemos el texto de los chunks contextualizados para el corpus
-    corpus = [chunk['contextualized_chunk'] for chunk in chunks]
-    
-    # El tokenizador simple divide por espacios en blanco. Es suficiente para empezar.
-    tokenized_corpus = [doc.split(" ") for doc in corpus]
-    
     bm25 = BM25Okapi(tokenized_corpus)
     
     # Guardamos el objeto bm25 en un archivo para su uso futuro
@@ -66,8 +59,8 @@ def create_bm25_index(chunks: list):
         
     print(f"Índice BM25 creado y guardado en '{BM25_INDEX_FILE}'.")
 
-def index_in_qdrant(chunks: list, embeddings_model: OllamaEmbeddings):
-    """Genera embeddings y los indexa en Qdrant en lotes."""
+def index_in_qdrant(chunks, embeddings_model: OllamaEmbeddings):
+    """Genera embeddings y los indexa en Qdrant en lotes, leyendo los chunks a medida que se necesitan."""
     print("\nIniciando indexación en Qdrant...")
     
     # 1. Inicializar el cliente de Qdrant
@@ -82,19 +75,22 @@ def index_in_qdrant(chunks: list, embeddings_model: OllamaEmbeddings):
         print(f"Colección '{QDRANT_COLLECTION_NAME}' creada/recreada en Qdrant.")
     except Exception as e:
         print(f"Error al crear la colección en Qdrant: {e}")
-        return
+        return False
 
     # 3. Preparar los datos y subirlos en lotes
     batch_size = 64 # Puedes ajustar este tamaño según la memoria de tu máquina
-    total_chunks = len(chunks)
+    chunks = iter(chunks)
+    i = 0
     
-    for i in range(0, total_chunks, batch_size):
-        batch_chunks = chunks[i:i+batch_size]
+    while True:
+        batch_chunks = list(islice(chunks, batch_size))
+        if not batch_chunks:
+            break
         
         # Extraemos el texto a "embeddear"
         texts_to_embed = [chunk['contextualized_chunk'] for chunk in batch_chunks]
         
-        print(f"Procesando lote {i//batch_size + 1}/{(total_chunks + batch_size - 1)//batch_size}... (chunks {i+1}-{min(i+batch_size, total_chunks)})")
+        print(f"Procesando lote {i//batch_size + 1}... (chunks {i+1}-{i+len(batch_chunks)})")
         
         # Generar embeddings para el lote
         embeddings = embeddings_model.embed_documents(texts_to_embed)
@@ -121,24 +117,35 @@ def index_in_qdrant(chunks: list, embeddings_model: OllamaEmbeddings):
             points=points_to_upload,
             wait=True # Esperar a que la operación se complete
         )
+        i += len(batch_chunks)
         
-    print("\n¡Indexación en Qdrant completada con éxito!")
+    print(f"\n¡Indexación en Qdrant completada con éxito! ({i} chunks)")
+    return True
 
 
 if __name__ == "__main__":
-    # 1. Cargar los chunks procesados
-    all_chunks = load_chunks_from_json(INPUT_JSON_FILE)
+    # 1. Abrir los chunks procesados en streaming (no se carga el fichero entero en memoria)
+    if not os.path.exists(INPUT_JSON_FILE):
+        print(f"Error: No se encontró el archivo '{INPUT_JSON_FILE}'. Asegúrate de que existe.")
+        sys.exit(1)
+    print(f"Leyendo chunks desde '{INPUT_JSON_FILE}'...")
+    chunks = iter_chunks(INPUT_JSON_FILE)
+    first_chunk = next(chunks, None)
     
-    if all_chunks:
-        # 2. Crear y guardar el índice BM25
-        create_bm25_index(all_chunks)
-        
-        # 3. Inicializar el modelo de embeddings de Ollama
+    if first_chunk is not None:
+        # 2. Inicializar el modelo de embeddings de Ollama
         print(f"\nInicializando modelo de embeddings '{OLLAMA_EMBEDDING_MODEL}' desde Ollama...")
-        ollama_embeddings = OllamaEmbeddings(
-            base_url=OLLAMA_BASE_URL,
-            model=OLLAMA_EMBEDDING_MODEL
+        ollama_embeddings = CachedDocumentEmbeddings(
+            OllamaEmbeddings(base_url=OLLAMA_BASE_URL, model=OLLAMA_EMBEDDING_MODEL),
+            MmapEmbeddingStore(EMBEDDING_CACHE_DIR, OLLAMA_EMBEDDING_MODEL),
         )
         
-        # 4. Indexar los datos en Qdrant
-        index_in_qdrant(all_chunks, ollama_embeddings)
+        # 3. Indexar los datos en Qdrant; en la misma pasada se tokeniza el corpus para BM25
+        tokenized_corpus = []
+        if index_in_qdrant(iter_tokenized(chain([first_chunk], chunks), tokenized_corpus), ollama_embeddings):
+            print(f"Embeddings desde la caché: {ollama_embeddings.hits}; calculados con Ollama: {ollama_embeddings.misses}.")
+            
+            # 4. Crear y guardar el índice BM25
+            create_bm25_index(tokenized_corpus)
+    else:
+        print("No se encontraron chunks para procesar.")
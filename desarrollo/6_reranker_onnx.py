@@ -0,0 +1,112 @@
+# Hito 6: Reranker ONNX int8 (exportación y prueba de paridad)
+# -----------------------------------------------------------------
+# Objetivo: Exportar el cross-encoder ms-marco a ONNX con cuantización dinámica int8 y
+#           comprobar, sobre un conjunto fijo de preguntas, que el ranking coincide con el
+#           del CrossEncoder original (fp32, PyTorch) mientras baja la latencia.
+# Librerías necesarias:
+# pip install sentence-transformers onnxruntime onnx
+#
+# Uso (desde la raíz del proyecto):
+#   python desarrollo/6_reranker_onnx.py
+# Después, arrancar el backend con RERANKER_BACKEND=onnx.
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from graph.analyzer import analyzer
+from graph.bm25 import build_partitioned_index
+from graph.chunk_io import iter_chunks
+from graph.onnx_reranker import OnnxCrossEncoder, export_onnx_model
+
+# --- CONFIGURACIÓN ---
+MODEL_NAME = "cross-encoder/ms-marco-minilm-l-6-v2"
+ONNX_MODEL_PATH = os.getenv("RERANKER_ONNX_PATH", "models/ms-marco-minilm-l-6-v2-int8.onnx")
+INPUT_JSON_FILE = os.getenv("INPUT_JSON_FILE", "all_chunks_unificado.json")
+CANDIDATES_PER_QUERY = 20
+TOP_K = 5
+# Umbrales mínimos para dar por buena la paridad
+MIN_TOP_K_OVERLAP = 0.8
+MIN_SPEARMAN = 0.9
+
+# Conjunto fijo de preguntas de prueba
+PARITY_QUERIES = [
+    "¿Cuáles son las cuentas del grupo 1?",
+    "¿Cómo se registra la amortización del inmovilizado intangible?",
+    "¿Qué es el patrimonio neto?",
+    "¿Cómo se contabiliza un arrendamiento financiero?",
+    "¿Qué recoge la cuenta 430 Clientes?",
+    "Normas de valoración de las existencias",
+    "¿Qué son los gastos de establecimiento en el plan de 1990?",
+    "Diferencias de cambio en moneda extranjera",
+    "¿Qué información debe incluir la memoria?",
+    "Provisiones para riesgos y gastos",
+]
+
+
+def spearman(a: np.ndarray, b: np.ndarray) -> float:
+    """Correlación de Spearman entre dos listas de scores (sin empates relevantes)."""
+    rank_a = np.argsort(np.argsort(a))
+    rank_b = np.argsort(np.argsort(b))
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+def build_candidates(chunks: list) -> list:
+    """Para cada pregunta, los CANDIDATES_PER_QUERY mejores chunks según BM25."""
+    index = build_partitioned_index((chunk['contextualized_chunk'] for chunk in chunks),
+                                    [chunk.get('source', '') for chunk in chunks])
+    candidates = []
+    for query in PARITY_QUERIES:
+        ids, _ = index.get_top_n(analyzer.analyze(query), CANDIDATES_PER_QUERY)
+        candidates.append([(query, chunks[i]['contextualized_chunk']) for i in ids.tolist()])
+    return candidates
+
+
+def timed_predict(model, pairs: list) -> tuple:
+    start = time.perf_counter()
+    scores = np.asarray(model.predict(pairs, batch_size=len(pairs)))
+    return scores, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    from sentence_transformers import CrossEncoder
+
+    if not os.path.exists(ONNX_MODEL_PATH):
+        print(f"Exportando '{MODEL_NAME}' a ONNX int8 en '{ONNX_MODEL_PATH}'...")
+        export_onnx_model(MODEL_NAME, ONNX_MODEL_PATH)
+
+    print(f"Cargando chunks desde '{INPUT_JSON_FILE}'...")
+    # JSON Lines o array JSON: los candidatos se eligen por posición, así que se necesita la lista completa
+    chunks = list(iter_chunks(INPUT_JSON_FILE))
+    candidates = build_candidates(chunks)
+
+    torch_model = CrossEncoder(MODEL_NAME, max_length=512)
+    onnx_model = OnnxCrossEncoder(ONNX_MODEL_PATH, MODEL_NAME, max_length=512)
+
+    overlaps, correlations, torch_times, onnx_times = [], [], [], []
+    for pairs in candidates:
+        if len(pairs) < 2:
+            continue
+        torch_scores, torch_time = timed_predict(torch_model, pairs)
+        onnx_scores, onnx_time = timed_predict(onnx_model, pairs)
+        top_torch = set(np.argsort(-torch_scores)[:TOP_K].tolist())
+        top_onnx = set(np.argsort(-onnx_scores)[:TOP_K].tolist())
+        overlaps.append(len(top_torch & top_onnx) / min(TOP_K, len(pairs)))
+        correlations.append(spearman(torch_scores, onnx_scores))
+        torch_times.append(torch_time)
+        onnx_times.append(onnx_time)
+        print(f"- {pairs[0][0][:60]:<60} top-{TOP_K}: {overlaps[-1]:.2f}  spearman: {correlations[-1]:.3f}")
+
+    mean_overlap, mean_spearman = float(np.mean(overlaps)), float(np.mean(correlations))
+    print(f"\nSolapamiento medio top-{TOP_K}: {mean_overlap:.3f}")
+    print(f"Spearman medio: {mean_spearman:.3f}")
+    print(f"Latencia media por pregunta: PyTorch {np.mean(torch_times)*1000:.1f} ms, ONNX int8 {np.mean(onnx_times)*1000:.1f} ms")
+    print(f"Tamaño del modelo ONNX: {os.path.getsize(ONNX_MODEL_PATH) / 1e6:.1f} MB")
+
+    if mean_overlap < MIN_TOP_K_OVERLAP or mean_spearman < MIN_SPEARMAN:
+        print("\nERROR: El modelo ONNX no alcanza la paridad mínima con el CrossEncoder original.")
+        sys.exit(1)
+    print("\nParidad correcta: se puede usar RERANKER_BACKEND=onnx.")
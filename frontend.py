@@ -83,6 +83,8 @@
 
 import streamlit as st
 import requests
+import itertools
+import json
 import os
 
 # --- Configuración ---
@@ -92,6 +94,8 @@ st.set_page_config(
     layout="centered"
 )
 API_URL = os.getenv("API_URL", "http://127.0.0.1:8000/chat")
+# Endpoint de streaming (NDJSON); por defecto, el de API_URL con el sufijo /stream
+STREAM_API_URL = os.getenv("STREAM_API_URL", API_URL.rstrip("/") + "/stream")
 
 WELCOME_MESSAGE = {
     "role": "assistant",
@@ -105,6 +109,19 @@ def reset_conversation():
     st.session_state.conversation_id = None
     st.success("Conversación reiniciada.")
 
+def stream_answer(response):
+    """Devuelve los tokens del stream NDJSON de la API a medida que llegan (para st.write_stream)."""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            continue
+        event = json.loads(line)
+        if event["type"] == "token":
+            yield event["content"]
+        elif event["type"] == "end":
+            st.session_state.conversation_id = event["conversation_id"]
+        elif event["type"] == "error":
+            raise requests.exceptions.RequestException(event["detail"])
+
 # --- Barra Lateral ---
 with st.sidebar:
     st.header("Opciones")
@@ -140,20 +157,18 @@ if prompt := st.chat_input("Escribe tu pregunta aquí..."):
     }
 
     with st.chat_message("assistant"):
-        with st.spinner("Pensando..."):
-            try:
-                response = requests.post(API_URL, json=payload)
+        try:
+            with requests.post(STREAM_API_URL, json=payload, stream=True) as response:
                 response.raise_for_status()
-                
-                data = response.json()
-                assistant_response = data["assistant_response"]
-                
-                st.session_state.conversation_id = data["conversation_id"]
-                
-                st.markdown(assistant_response)
-                st.session_state.messages.append({"role": "assistant", "content": assistant_response})
-
-            except requests.exceptions.RequestException as e:
-                error_message = f"Error al contactar la API: {e}"
-                st.error(error_message)
-                st.session_state.messages.append({"role": "assistant", "content": error_message})
\ No newline at end of file
+                tokens = stream_answer(response)
+                # El spinner se muestra hasta el primer token (recuperación y reranking);
+                # a partir de ahí el texto se escribe según lo genera el modelo.
+                with st.spinner("Pensando..."):
+                    first_token = next(tokens, "")
+                assistant_response = st.write_stream(itertools.chain([first_token], tokens))
+            st.session_state.messages.append({"role": "assistant", "content": assistant_response})
+
+        except requests.exceptions.RequestException as e:
+            error_message = f"Error al contactar la API: {e}"
+            st.error(error_message)
+            st.session_state.messages.append({"role": "assistant", "content": error_message})
\ No newline at end of file
@@ -0,0 +1,141 @@
+# graph/admission.py
+# Control de admisión delante de los modelos de Ollama.
+# Cada modelo (router, embeddings, generador) tiene su propio límite de llamadas simultáneas y una
+# cola de espera acotada con timeout. Si la cola está llena se rechaza al momento (429) y si la espera
+# supera el timeout se abandona (503); en ambos casos con una estimación de Retry-After.
+# Así una ráfaga no satura el host de Ollama y la latencia de cola se mantiene predecible.
+
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+
+class OverloadedError(Exception):
+    """El modelo está saturado. 'status_code' y 'retry_after' (segundos) se devuelven al cliente."""
+
+    status_code = 503
+
+    def __init__(self, name: str, retry_after: int, reason: str):
+        super().__init__(f"Modelo '{name}' saturado: {reason}")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class QueueFullError(OverloadedError):
+    status_code = 429
+
+
+class QueueTimeoutError(OverloadedError):
+    status_code = 503
+
+
+class AdmissionLimiter:
+    """
+    Atributos:
+        max_concurrency: Llamadas simultáneas permitidas al modelo.
+        max_queue: Peticiones que pueden esperar turno; la siguiente se rechaza.
+        queue_timeout: Segundos máximos de espera en la cola.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._total_service = 0.0
+        self._completed = 0
+
+    def retry_after(self) -> int:
+        """Segundos estimados hasta que haya hueco: tiempo medio de servicio por turnos pendientes."""
+        avg_service = self._total_service / self._completed if self._completed else 1.0
+        return max(1, math.ceil(avg_service * (self.waiting + 1) / self.max_concurrency))
+
+    def check(self):
+        """Rechaza de inmediato si no hay hueco ni sitio en la cola (útil antes de empezar un stream)."""
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(self.name, self.retry_after(), "cola de espera llena")
+
+    @asynccontextmanager
+    async def slot(self):
+        """Espera turno (como mucho queue_timeout) y lo mantiene mientras dura el bloque."""
+        self.check()
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise QueueTimeoutError(self.name, self.retry_after(), "tiempo de espera agotado") from None
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self._total_wait += waited
+        self._max_wait = max(self._max_wait, waited)
+
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._total_service += time.monotonic() - started
+            self._completed += 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self._total_wait / self.admitted * 1000, 2) if self.admitted else 0.0,
+            "max_wait_ms": round(self._max_wait * 1000, 2),
+            "avg_service_ms": round(self._total_service / self._completed * 1000, 2) if self._completed else 0.0,
+        }
+
+
+class AdmissionControlled:
+    """
+    Envoltorio de un modelo de LangChain (ChatOllama u OllamaEmbeddings) cuyas llamadas asíncronas
+    pasan por un AdmissionLimiter. El resto de atributos y métodos se delegan sin cambios.
+    """
+
+    def __init__(self, model, limiter: AdmissionLimiter):
+        self.model = model
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    async def ainvoke(self, *args, **kwargs):
+        async with self.limiter.slot():
+            return await self.model.ainvoke(*args, **kwargs)
+
+    async def astream(self, *args, **kwargs):
+        # El turno se mantiene mientras se generan los tokens.
+        async with self.limiter.slot():
+            async for chunk in self.model.astream(*args, **kwargs):
+                yield chunk
+
+    async def aembed_query(self, text: str):
+        async with self.limiter.slot():
+            return await self.model.aembed_query(text)
+
+    async def aembed_documents(self, texts):
+        async with self.limiter.slot():
+            return await self.model.aembed_documents(texts)
@@ -0,0 +1,77 @@
+# graph/analyzer.py
+# Analizador de texto en español compartido por la indexación (ingest.py) y la consulta (nodes.py).
+# Normaliza Unicode, pasa a minúsculas, elimina tildes y signos de puntuación, y opcionalmente
+# quita stopwords y aplica un stemming ligero. Así "Amortización," y "amortizacion" son el mismo término.
+
+import re
+import unicodedata
+from typing import List
+
+# Tildes y diéresis -> vocal base. La 'ñ' se conserva porque distingue palabras ("año" / "ano").
+_FOLD_TABLE = str.maketrans({
+    "á": "a", "à": "a", "â": "a", "ä": "a", "ã": "a",
+    "é": "e", "è": "e", "ê": "e", "ë": "e",
+    "í": "i", "ì": "i", "î": "i", "ï": "i",
+    "ó": "o", "ò": "o", "ô": "o", "ö": "o", "õ": "o",
+    "ú": "u", "ù": "u", "û": "u", "ü": "u",
+})
+
+# Secuencias de letras o dígitos; todo lo demás (puntuación, saltos de línea, guiones...) separa tokens.
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+SPANISH_STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes como con contra cual cuales cuando de del desde
+donde durante e el ella ellas ellos en entre era eran es esa esas ese eso esos esta estan estas este esto
+estos fue fueron ha han hasta hay la las le les lo los mas me mi mientras muy nos o otra otras otro otros
+para pero por porque que quien quienes se sea sean segun ser si sido sin sino sobre son su sus tambien tanto te tiene tienen
+todo todos tu un una unas uno unos y ya
+""".split())
+
+
+def fold_text(text: str) -> str:
+    """Normaliza Unicode, pasa a minúsculas y quita tildes (conserva la 'ñ'). La usan también las reglas del router."""
+    return unicodedata.normalize("NFKC", text).lower().translate(_FOLD_TABLE)
+
+
+def light_stem(token: str) -> str:
+    """Stemming ligero para español (plurales y género), equivalente al SpanishLightStemmer de Lucene."""
+    if len(token) < 5:
+        return token
+    last = token[-1]
+    if last in "oae":
+        return token[:-1]
+    if last == "s":
+        if token.endswith("eses"):
+            return token[:-2]
+        if token.endswith("ces"):
+            return token[:-3] + "z"
+        if token[-2] in "oae":
+            return token[:-2]
+    return token
+
+
+class SpanishAnalyzer:
+    """Convierte un texto en la lista de términos que se indexan o se buscan en BM25."""
+
+    def __init__(self, remove_stopwords: bool = True, stem: bool = True):
+        self.remove_stopwords = remove_stopwords
+        self.stem = stem
+
+    @property
+    def version(self) -> str:
+        """Identificador que se guarda en la cabecera del índice para detectar cambios de tokenización."""
+        flags = ("+stop" if self.remove_stopwords else "") + ("+stem" if self.stem else "")
+        return f"es-analyzer-v1{flags}"
+
+    def analyze(self, text: str) -> List[str]:
+        text = fold_text(text)
+        tokens = _TOKEN_RE.findall(text)
+        if self.remove_stopwords:
+            tokens = [token for token in tokens if token not in SPANISH_STOPWORDS]
+        if self.stem:
+            tokens = [light_stem(token) for token in tokens]
+        return tokens
+
+
+# Analizador por defecto: el mismo objeto se usa al indexar y al consultar.
+analyzer = SpanishAnalyzer()
@@ -0,0 +1,72 @@
+# graph/answer_cache.py
+# Caché semántica de respuestas: si llega una pregunta muy parecida (similitud coseno de los
+# embeddings por encima de un umbral) a otra ya respondida, con la misma fuente de datos y la
+# misma versión del corpus, se devuelve la respuesta guardada sin recuperar ni generar.
+
+import itertools
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from graph.cache import LRUCache
+
+
+class AnswerCache:
+    """
+    Atributos:
+        threshold: Similitud coseno mínima para considerar que dos preguntas son la misma.
+        entries: LRUCache id -> entrada (vector normalizado, respuesta, datasource, versión del corpus).
+    """
+
+    def __init__(self, threshold: float = 0.95, maxsize: int = 500, ttl: Optional[float] = 86400):
+        self.threshold = threshold
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._ids = itertools.count()
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def lookup(self, question_vector: List[float], datasource: Optional[str], corpus_version: str) -> Optional[str]:
+        """
+        Devuelve la respuesta de la pregunta cacheada más parecida, o None si ninguna supera el umbral.
+        Con datasource=None se aceptan entradas de cualquier fuente de datos (consulta previa al router).
+        """
+        candidates = []
+        for entry_id, entry in self.entries.items():
+            if entry["corpus_version"] != corpus_version:
+                # El corpus se ha reindexado: la respuesta puede estar obsoleta.
+                self.entries.delete(entry_id)
+            elif datasource is None or entry["datasource"] == datasource:
+                candidates.append((entry_id, entry))
+        if not candidates:
+            self.entries.misses += 1
+            return None
+
+        matrix = np.stack([entry["vector"] for _, entry in candidates])
+        similarities = matrix @ self._normalize(question_vector)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            self.entries.misses += 1
+            return None
+        # get() marca la entrada como usada recientemente y cuenta el acierto.
+        entry = self.entries.get(candidates[best][0])
+        return entry["answer"] if entry is not None else None
+
+    def store(self, question_vector: List[float], datasource: str, corpus_version: str, answer: str):
+        self.entries.set(next(self._ids), {
+            "vector": self._normalize(question_vector),
+            "answer": answer,
+            "datasource": datasource,
+            "corpus_version": corpus_version,
+        })
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> Dict:
+        stats = self.entries.stats()
+        stats["threshold"] = self.threshold
+        return stats
@@ -0,0 +1,354 @@
+# graph/bm25.py
+# Motor BM25 disperso basado en listas de postings (formato CSR).
+# Sustituye al BM25Okapi de rank_bm25 (mismo k1/b/epsilon y fórmula de IDF): en lugar de recorrer en Python todos los
+# documentos por cada token de la consulta, solo se puntúan los documentos que
+# contienen algún término de la consulta, con acumulación vectorizada en NumPy.
+#
+# Formato en disco (directorio, versión INDEX_FORMAT_VERSION):
+#   header.json          formato, versión, tokenizer, hash del corpus, k1, b y la lista de particiones
+#   <p>.terms.json       vocabulario de la partición (el término i tiene id i)
+#   <p>.indptr.npy       int64 (V+1,)  inicio de la lista de postings de cada término
+#   <p>.doc_ids.npy      int32 (P,)    id local de documento de cada posting
+#   <p>.tfs.npy          float32 (P,)  frecuencia del término en el documento
+#   <p>.weights.npy      float32 (P,)  componente tf/longitud de BM25 precalculada
+#   <p>.idf.npy          float32 (V,)  IDF de cada término
+#   <p>.doc_len.npy      int32 (N,)    longitud de cada documento
+#   <p>.global_ids.npy   int64 (N,)    id global de chunk de cada documento local
+# Los arrays .npy se abren con mmap, sin copiarlos a memoria ni usar pickle.
+
+import json
+import os
+import shutil
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+from graph.analyzer import analyzer
+
+# Parámetros por defecto de BM25Okapi (rank_bm25) para mantener el mismo ranking.
+DEFAULT_K1 = 1.5
+DEFAULT_B = 0.75
+DEFAULT_EPSILON = 0.25
+
+# Nombre de la partición que contiene el corpus completo.
+ALL_PARTITION = "all"
+
+INDEX_FORMAT = "bm25-csr"
+INDEX_FORMAT_VERSION = 1
+# Identifica la tokenización usada al indexar; si cambia, el índice debe reconstruirse.
+TOKENIZER_VERSION = analyzer.version
+_ARRAYS = ("indptr", "doc_ids", "tfs", "weights", "idf", "doc_len")
+
+
+class StaleIndexError(ValueError):
+    """El índice en disco no corresponde al corpus o al tokenizer actuales."""
+
+
+class SparseBM25:
+    """
+    Índice BM25 invertido en formato CSR.
+
+    Atributos:
+        vocab: Diccionario término -> id de término.
+        indptr: Array (V+1,) con el inicio de la lista de postings de cada término.
+        doc_ids: Array (P,) con los ids de documento de cada posting, ordenados por término.
+        tfs: Array (P,) con la frecuencia del término en el documento de cada posting.
+        idf: Array (V,) con el IDF de cada término.
+        doc_len: Array (N,) con la longitud (en tokens) de cada documento.
+        weights: Array (P,) con la parte de BM25 que depende de tf y de la longitud del documento.
+    """
+
+    def __init__(self, vocab: dict, indptr: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray,
+                 idf: np.ndarray, doc_len: np.ndarray, k1: float = DEFAULT_K1, b: float = DEFAULT_B,
+                 weights: Optional[np.ndarray] = None):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.idf = idf
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        if weights is None:
+            weights = self._compute_weights(tfs, doc_len[doc_ids], doc_len, k1, b)
+        self.weights = weights
+
+    @property
+    def corpus_size(self) -> int:
+        return int(self.doc_len.shape[0])
+
+    # --- Construcción ---
+    @classmethod
+    def from_corpus(cls, tokenized_corpus: Iterable[Sequence[str]], k1: float = DEFAULT_K1,
+                    b: float = DEFAULT_B, epsilon: float = DEFAULT_EPSILON) -> "SparseBM25":
+        """Construye el índice a partir de un corpus ya tokenizado."""
+        builder = BM25Builder()
+        for tokens in tokenized_corpus:
+            builder.add_tokens(tokens)
+        return builder.build_unified(k1, b, epsilon)
+
+    @classmethod
+    def _from_postings(cls, vocab: dict, term_col, doc_col, tf_col, doc_len, k1: float, b: float,
+                       epsilon: float = DEFAULT_EPSILON, idf: np.ndarray = None) -> "SparseBM25":
+        term_col = np.asarray(term_col, dtype=np.int64)
+        doc_col = np.asarray(doc_col, dtype=np.int32)
+        tf_col = np.asarray(tf_col, dtype=np.float32)
+        doc_len = np.asarray(doc_len, dtype=np.int32)
+
+        # Ordenamos los postings por término (estable, así cada lista queda ordenada por documento).
+        order = np.argsort(term_col, kind="stable")
+        doc_col, tf_col = doc_col[order], tf_col[order]
+        df = np.bincount(term_col, minlength=len(vocab))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+
+        if idf is None:
+            idf = cls._compute_idf(df, len(doc_len), epsilon)
+        return cls(vocab, indptr, doc_col, tf_col, idf, doc_len, k1, b)
+
+    def subset(self, global_ids: Sequence[int], epsilon: float = DEFAULT_EPSILON) -> "SparseBM25":
+        """
+        Crea un índice independiente con solo los documentos indicados, reutilizando los postings.
+        El documento local i del nuevo índice corresponde a global_ids[i].
+        """
+        global_ids = np.asarray(global_ids, dtype=np.int64)
+        local_ids = np.full(self.corpus_size, -1, dtype=np.int64)
+        local_ids[global_ids] = np.arange(global_ids.size)
+
+        posting_terms = np.repeat(np.arange(len(self.vocab)), np.diff(self.indptr))
+        keep = local_ids[self.doc_ids] >= 0
+        posting_terms = posting_terms[keep]
+
+        # Los términos que no aparecen en el subconjunto se eliminan del vocabulario.
+        used = np.bincount(posting_terms, minlength=len(self.vocab)) > 0
+        new_term_ids = np.cumsum(used) - 1
+        vocab = {term: int(new_term_ids[term_id]) for term, term_id in self.vocab.items() if used[term_id]}
+        return self._from_postings(vocab, new_term_ids[posting_terms], local_ids[self.doc_ids[keep]],
+                                   self.tfs[keep], self.doc_len[global_ids], self.k1, self.b, epsilon)
+
+    @staticmethod
+    def _compute_idf(df: np.ndarray, corpus_size: int, epsilon: float) -> np.ndarray:
+        # Misma fórmula que BM25Okapi: los IDF negativos se sustituyen por epsilon * IDF medio.
+        idf = np.log(corpus_size - df + 0.5) - np.log(df + 0.5)
+        average_idf = float(idf.sum()) / len(idf) if len(idf) else 0.0
+        idf[idf < 0] = epsilon * average_idf
+        return idf.astype(np.float32)
+
+    @staticmethod
+    def _compute_weights(tf: np.ndarray, posting_doc_len: np.ndarray, doc_len: np.ndarray,
+                         k1: float, b: float) -> np.ndarray:
+        avgdl = float(doc_len.mean()) if len(doc_len) else 0.0
+        norm = k1 * (1 - b + b * posting_doc_len / (avgdl or 1.0))
+        return (tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+
+    # --- Consulta ---
+    def _query_postings(self, tokenized_query: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Devuelve (doc_ids, contribuciones) de todos los postings de los términos de la consulta."""
+        ids_parts, score_parts = [], []
+        for term, count in Counter(tokenized_query).items():
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            ids_parts.append(self.doc_ids[start:end])
+            score_parts.append(self.weights[start:end] * (self.idf[term_id] * count))
+        if not ids_parts:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        return np.concatenate(ids_parts), np.concatenate(score_parts)
+
+    def get_candidate_scores(self, tokenized_query: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Puntúa solo los documentos que contienen algún término de la consulta."""
+        doc_ids, contributions = self._query_postings(tokenized_query)
+        if doc_ids.size == 0:
+            return doc_ids, contributions
+        candidates, inverse = np.unique(doc_ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions, minlength=candidates.size)
+        return candidates, scores
+
+    def get_top_n(self, tokenized_query: Sequence[str], n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Devuelve (ids, scores) de los n mejores documentos, ordenados de mayor a menor score."""
+        candidates, scores = self.get_candidate_scores(tokenized_query)
+        return top_k(candidates, scores, n)
+
+    def get_scores(self, tokenized_query: Sequence[str]) -> np.ndarray:
+        """Compatibilidad con BM25Okapi: devuelve el score de todos los documentos del corpus."""
+        scores = np.zeros(self.corpus_size, dtype=np.float64)
+        doc_ids, contributions = self._query_postings(tokenized_query)
+        np.add.at(scores, doc_ids, contributions)
+        return scores
+
+
+def top_k(ids: np.ndarray, scores: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Selecciona los n mejores con argpartition y ordena solo esos n."""
+    if n <= 0 or ids.size == 0:
+        return ids[:0], scores[:0]
+    if ids.size > n:
+        part = np.argpartition(-scores, n - 1)[:n]
+        ids, scores = ids[part], scores[part]
+    order = np.argsort(-scores, kind="stable")
+    return ids[order], scores[order]
+
+
+class PartitionedBM25:
+    """
+    Un índice BM25 unificado más un índice independiente por cada 'source' del corpus.
+
+    Atributos:
+        partitions: Diccionario partición -> SparseBM25. ALL_PARTITION contiene todo el corpus.
+        global_ids: Diccionario partición -> array con el id global de chunk de cada documento local.
+    """
+
+    def __init__(self, partitions: Dict[str, SparseBM25], global_ids: Dict[str, np.ndarray]):
+        self.partitions = partitions
+        self.global_ids = global_ids
+
+    @classmethod
+    def build(cls, index: SparseBM25, sources: Sequence[str]) -> "PartitionedBM25":
+        """Divide un índice unificado en particiones por 'source' (sources[i] es la fuente del chunk i)."""
+        sources = np.asarray(sources)
+        partitions = {ALL_PARTITION: index}
+        global_ids = {ALL_PARTITION: np.arange(index.corpus_size, dtype=np.int64)}
+        for source in np.unique(sources).tolist():
+            ids = np.flatnonzero(sources == source)
+            partitions[source] = index.subset(ids)
+            global_ids[source] = ids
+        return cls(partitions, global_ids)
+
+    @property
+    def corpus_size(self) -> int:
+        return self.partitions[ALL_PARTITION].corpus_size
+
+    def get_top_n(self, tokenized_query: Sequence[str], n: int, source: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Devuelve (ids globales, scores) de los n mejores documentos. Si se indica 'source',
+        solo se consulta la partición de esa fuente.
+        """
+        partition = ALL_PARTITION if source is None else source
+        if partition not in self.partitions:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        local_ids, scores = self.partitions[partition].get_top_n(tokenized_query, n)
+        return self.global_ids[partition][local_ids], scores
+
+    def get_scores(self, tokenized_query: Sequence[str]) -> np.ndarray:
+        """Compatibilidad con BM25Okapi: scores del índice unificado."""
+        return self.partitions[ALL_PARTITION].get_scores(tokenized_query)
+
+
+class BM25Builder:
+    """
+    Construcción incremental del índice, documento a documento (ingesta en streaming): solo se
+    guardan los postings en arrays compactos y la fuente de cada documento, nunca el texto.
+    """
+
+    def __init__(self):
+        self.vocab = {}
+        self._term_col = array("q")
+        self._doc_col = array("i")
+        self._tf_col = array("f")
+        self._doc_len = array("i")
+        self._sources = []
+
+    def __len__(self) -> int:
+        return len(self._doc_len)
+
+    def add(self, text: str, source: str = ""):
+        """Tokeniza 'text' con el analizador compartido y lo añade como el siguiente documento."""
+        self.add_tokens(analyzer.analyze(text), source)
+
+    def add_tokens(self, tokens: Sequence[str], source: str = ""):
+        doc_id = len(self._doc_len)
+        self._doc_len.append(len(tokens))
+        self._sources.append(source)
+        for term, tf in Counter(tokens).items():
+            self._term_col.append(self.vocab.setdefault(term, len(self.vocab)))
+            self._doc_col.append(doc_id)
+            self._tf_col.append(tf)
+
+    def build_unified(self, k1: float = DEFAULT_K1, b: float = DEFAULT_B,
+                      epsilon: float = DEFAULT_EPSILON) -> SparseBM25:
+        return SparseBM25._from_postings(self.vocab, self._term_col, self._doc_col, self._tf_col,
+                                         self._doc_len, k1, b, epsilon)
+
+    def build(self) -> PartitionedBM25:
+        """Índice unificado más una partición por cada fuente."""
+        return PartitionedBM25.build(self.build_unified(), self._sources)
+
+
+def build_partitioned_index(texts: Iterable[str], sources: Sequence[str]) -> PartitionedBM25:
+    """Tokeniza el corpus con el analizador compartido y construye el índice unificado y sus particiones."""
+    builder = BM25Builder()
+    for text, source in zip(texts, sources):
+        builder.add(text, source)
+    return builder.build()
+
+
+# --- Persistencia ---
+def save_index(index: PartitionedBM25, directory: str, corpus_hash: str,
+               tokenizer_version: str = TOKENIZER_VERSION):
+    """
+    Guarda el índice en el formato de directorio descrito arriba. Se escribe en un directorio
+    temporal y se sustituye al final, para no dejar nunca un índice a medio escribir.
+    """
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    partitions = {}
+    for position, (name, partition) in enumerate(index.partitions.items()):
+        prefix = f"p{position}"
+        partitions[name] = prefix
+        with open(os.path.join(tmp_directory, f"{prefix}.terms.json"), "w", encoding="utf-8") as f:
+            json.dump(list(partition.vocab), f, ensure_ascii=False)
+        for array_name in _ARRAYS:
+            np.save(os.path.join(tmp_directory, f"{prefix}.{array_name}.npy"), getattr(partition, array_name))
+        np.save(os.path.join(tmp_directory, f"{prefix}.global_ids.npy"), index.global_ids[name])
+
+    unified = index.partitions[ALL_PARTITION]
+    header = {
+        "format": INDEX_FORMAT,
+        "version": INDEX_FORMAT_VERSION,
+        "tokenizer": tokenizer_version,
+        "corpus_hash": corpus_hash,
+        "corpus_size": unified.corpus_size,
+        "k1": unified.k1,
+        "b": unified.b,
+        "partitions": partitions,
+    }
+    with open(os.path.join(tmp_directory, "header.json"), "w", encoding="utf-8") as f:
+        json.dump(header, f, indent=2)
+
+    old_directory = f"{directory}.old"
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def load_index(directory: str, expected_corpus_hash: Optional[str] = None,
+               tokenizer_version: str = TOKENIZER_VERSION) -> PartitionedBM25:
+    """
+    Abre un índice guardado con save_index() usando mmap. Lanza StaleIndexError si el índice
+    se construyó con otro tokenizer o sobre un corpus distinto del indicado.
+    """
+    with open(os.path.join(directory, "header.json"), "r", encoding="utf-8") as f:
+        header = json.load(f)
+    if header.get("format") != INDEX_FORMAT or header.get("version") != INDEX_FORMAT_VERSION:
+        raise StaleIndexError(f"Formato de índice no soportado: {header.get('format')} v{header.get('version')}")
+    if header["tokenizer"] != tokenizer_version:
+        raise StaleIndexError(f"El índice usa el tokenizer '{header['tokenizer']}' y se esperaba '{tokenizer_version}'.")
+    if expected_corpus_hash is not None and header["corpus_hash"] != expected_corpus_hash:
+        raise StaleIndexError("El índice BM25 no corresponde al almacén de chunks actual (hash del corpus distinto).")
+
+    partitions, global_ids = {}, {}
+    for name, prefix in header["partitions"].items():
+        with open(os.path.join(directory, f"{prefix}.terms.json"), "r", encoding="utf-8") as f:
+            vocab = {term: term_id for term_id, term in enumerate(json.load(f))}
+        arrays = {array_name: np.load(os.path.join(directory, f"{prefix}.{array_name}.npy"), mmap_mode="r")
+                  for array_name in _ARRAYS}
+        partitions[name] = SparseBM25(vocab, arrays["indptr"], arrays["doc_ids"], arrays["tfs"], arrays["idf"],
+                                      arrays["doc_len"], header["k1"], header["b"], weights=arrays["weights"])
+        global_ids[name] = np.load(os.path.join(directory, f"{prefix}.global_ids.npy"), mmap_mode="r")
+    return PartitionedBM25(partitions, global_ids)
@@ -2,14 +2,25 @@
 from IPython.display import Image, display
 from langgraph.graph import StateGraph, END
 from graph.state import RagGraphState
-from graph.nodes import rerank_documents, retrieve_documents, route_question, generate_answer, handle_no_documents, documents_exist
+from graph.nodes import (manage_history, rerank_documents, retrieve_dense, retrieve_sparse, retrieve_documents, route_question, generate_answer, handle_no_documents, documents_exist,
+                         lookup_raw_cached_answer, raw_answer_cached, lookup_cached_answer, store_cached_answer, answer_cached)
 from graph.memory import get_memory
 
 
 def build_sequential_graph ():
 
     workflow = StateGraph(RagGraphState)
+    # COMENTARIO: Primera consulta a la caché de respuestas, con la pregunta original, antes de las llamadas al LLM
+    workflow.add_node("answer_cache_raw", lookup_raw_cached_answer)
+    # COMENTARIO: Resumen del historial y reescritura de la pregunta antes de todo lo demás
+    workflow.add_node("history", manage_history)
     workflow.add_node("router", route_question)
+    # COMENTARIO: Caché semántica de respuestas (consulta tras el router y guardado tras el generador)
+    workflow.add_node("answer_cache", lookup_cached_answer)
+    workflow.add_node("answer_cache_store", store_cached_answer)
+    # COMENTARIO: Las búsquedas densa y BM25 son nodos paralelos; "retriever" espera a ambos y une resultados
+    workflow.add_node("dense_retriever", retrieve_dense)
+    workflow.add_node("sparse_retriever", retrieve_sparse)
     workflow.add_node("retriever", retrieve_documents)
     # COMENTARIO: Añadimos el nodo rerank
     workflow.add_node("rerank", rerank_documents)
@@ -17,8 +28,27 @@ def build_sequential_graph ():
     workflow.add_node("handle_no_docs", handle_no_documents)
 
     # COMENTARIO: Actualizamos el flujo para incluir el reranker
-    workflow.set_entry_point("router")
-    workflow.add_edge("router", "retriever")
+    workflow.set_entry_point("answer_cache_raw")
+    workflow.add_conditional_edges(
+        "answer_cache_raw",
+        raw_answer_cached,
+        {
+            "hit": END,
+            "miss": "history"
+        }
+    )
+    workflow.add_edge("history", "router")
+    workflow.add_edge("router", "answer_cache")
+    workflow.add_conditional_edges(
+        "answer_cache",
+        answer_cached,
+        {
+            "hit": END,
+            "dense": "dense_retriever",
+            "sparse": "sparse_retriever"
+        }
+    )
+    workflow.add_edge(["dense_retriever", "sparse_retriever"], "retriever")
     workflow.add_edge("retriever", "rerank") # El retriever ahora va al reranker
     workflow.add_conditional_edges(
         "rerank", # La condición ahora empieza desde el reranker
@@ -28,10 +58,12 @@ def build_sequential_graph ():
             "handle_no_docs": "handle_no_docs"
         }
     )
-    workflow.add_edge("generator", END)
+    workflow.add_edge("generator", "answer_cache_store")
+    workflow.add_edge("answer_cache_store", END)
     workflow.add_edge("handle_no_docs", END)
 
-    graph = workflow.compile()
+    # COMENTARIO: El historial de cada conversation_id se guarda en el checkpointer SQLite
+    graph = workflow.compile(checkpointer=get_memory())
     #display(Image(graph.get_graph(xray=True).draw_mermaid_png()))
     return graph
 
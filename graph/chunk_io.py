@@ -0,0 +1,86 @@
+# graph/chunk_io.py
+# Lectura y escritura en streaming de los ficheros de chunks contextualizados.
+# Formato nuevo: JSON Lines (.jsonl), un chunk (objeto JSON) por línea; se puede escribir a medida que
+# se generan los chunks y leer sin cargar el fichero entero.
+# Se siguen leyendo los ficheros antiguos (un array JSON de objetos), también chunk a chunk: el array
+# se decodifica por bloques con JSONDecoder.raw_decode, sin json.load del fichero completo.
+
+import json
+from typing import IO, Iterable, Iterator
+
+_BLOCK_SIZE = 1 << 20  # Caracteres leídos por bloque al decodificar un array JSON
+_decoder = json.JSONDecoder()
+
+
+def _skip_whitespace(buffer: str, position: int) -> int:
+    while position < len(buffer) and buffer[position].isspace():
+        position += 1
+    return position
+
+
+def _iter_json_array(f: IO[str], buffer: str) -> Iterator[dict]:
+    """Elementos de un array JSON leído por bloques; 'buffer' empieza justo después del '['."""
+    position, eof = 0, False
+    while True:
+        position = _skip_whitespace(buffer, position)
+        if position == len(buffer):
+            if eof:
+                raise ValueError("Array JSON de chunks incompleto (falta el ']' final).")
+            block = f.read(_BLOCK_SIZE)
+            eof = not block
+            buffer, position = block, 0
+            continue
+        if buffer[position] == "]":
+            return
+        if buffer[position] == ",":
+            position += 1
+            continue
+        try:
+            item, end = _decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            item, end = None, len(buffer)
+        # Un elemento que llega hasta el final del bloque puede estar incompleto: se lee más y se reintenta.
+        if end == len(buffer) and not eof:
+            block = f.read(_BLOCK_SIZE)
+            eof = not block
+            buffer, position = buffer[position:] + block, 0
+            continue
+        if item is None:
+            raise ValueError("Array JSON de chunks mal formado.")
+        yield item
+        position = end
+
+
+def iter_chunks(filename: str) -> Iterator[dict]:
+    """Recorre los chunks de un fichero JSON Lines o de un array JSON (formato antiguo), uno a uno."""
+    with open(filename, "r", encoding="utf-8") as f:
+        head = f.read(_BLOCK_SIZE)
+        start = _skip_whitespace(head, 0)
+        if head[start:start + 1] == "[":
+            yield from _iter_json_array(f, head[start + 1:])
+            return
+        f.seek(0)
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Línea {line_number} de '{filename}' no es JSON válido: {e}") from None
+
+
+def write_chunk_line(f: IO[str], chunk: dict):
+    """Añade un chunk como una línea JSON."""
+    f.write(json.dumps(chunk, ensure_ascii=False))
+    f.write("\n")
+
+
+def write_chunks_jsonl(chunks: Iterable[dict], filename: str) -> int:
+    """Escribe los chunks en formato JSON Lines. Devuelve cuántos se han escrito."""
+    count = 0
+    with open(filename, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            write_chunk_line(f, chunk)
+            count += 1
+    return count
@@ -0,0 +1,285 @@
+# graph/chunk_store.py
+# Almacén binario de chunks abierto con mmap.
+# Evita hacer json.load del corpus completo en cada worker: el texto de cada chunk se lee
+# directamente del fichero mapeado en memoria (compartido entre procesos por el sistema operativo).
+#
+# Formato del fichero:
+#   MAGIC (8 bytes) | longitud de la cabecera (uint64 little-endian) | cabecera JSON (UTF-8)
+#   | secciones alineadas a 8 bytes: offsets (uint64, N+1), source_ids (uint16, N),
+#     parent_ids (int32, N), point_ids (UUID de 16 bytes, N),
+#     texts (blob UTF-8 con todos los 'contextualized_chunk' concatenados)
+#
+# El id de cada punto en Qdrant es un UUID derivado del contenido del chunk (chunk_point_id), así que
+# no cambia aunque el chunk cambie de posición. El backend traduce ese UUID al id (posición) del chunk.
+#
+# ChunkStoreWriter escribe el almacén chunk a chunk (ingesta en streaming): el texto se vuelca a un
+# fichero temporal y en memoria solo quedan los arrays de tamaño fijo por chunk.
+
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import uuid
+from array import array
+from typing import IO, Dict, Iterable, List, Optional
+
+import numpy as np
+
+MAGIC = b"CHNKSTR1"
+FORMAT_VERSION = 2
+_ALIGN = 8
+# Espacio de nombres de los UUID (versión 5) de los puntos de Qdrant
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "chatbot_finanzas/chunks")
+
+
+def _pad(size: int) -> int:
+    return (-size) % _ALIGN
+
+
+def _hash_chunk(digest, chunk: dict):
+    digest.update(chunk.get("source", "").encode("utf-8") + b"\0")
+    digest.update(chunk["contextualized_chunk"].encode("utf-8") + b"\0")
+
+
+def compute_corpus_hash(chunks: Iterable[dict]) -> str:
+    """Hash (sha256) del texto y la fuente de todos los chunks, en orden. Identifica una versión del corpus."""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        _hash_chunk(digest, chunk)
+    return digest.hexdigest()
+
+
+def chunk_point_id(chunk: dict) -> str:
+    """Id determinista del punto en Qdrant: UUID del contenido que se embebe (fuente y texto)."""
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, chunk.get("source", "") + "\0" + chunk["contextualized_chunk"]))
+
+
+class ChunkStoreWriter:
+    """
+    Construye el almacén añadiendo los chunks de uno en uno (add) y lo escribe al final (save o write_to).
+    El texto se guarda en un fichero temporal (en memoria mientras es pequeño).
+    """
+
+    _SPOOL_MAX_SIZE = 16 << 20
+
+    def __init__(self):
+        self._texts = tempfile.SpooledTemporaryFile(max_size=self._SPOOL_MAX_SIZE)
+        self._offsets = array("Q", [0])
+        self._source_ids = array("H")
+        self._parent_ids = array("i")
+        self._point_ids = bytearray()
+        self._source_names: List[str] = []
+        self._source_index: Dict[str, int] = {}
+        self._digest = hashlib.sha256()
+
+    def __len__(self) -> int:
+        return len(self._source_ids)
+
+    @property
+    def corpus_hash(self) -> str:
+        """Hash del corpus añadido hasta ahora (el mismo que compute_corpus_hash)."""
+        return self._digest.hexdigest()
+
+    def add(self, chunk: dict):
+        """Añade un chunk (dict del fichero de ingesta) como el siguiente id."""
+        source = chunk.get("source", "")
+        if source not in self._source_index:
+            self._source_index[source] = len(self._source_names)
+            self._source_names.append(source)
+        self._source_ids.append(self._source_index[source])
+        self._parent_ids.append(chunk.get("parent_doc_index", -1))
+        self._point_ids += uuid.UUID(chunk_point_id(chunk)).bytes
+        text = chunk["contextualized_chunk"].encode("utf-8")
+        self._texts.write(text)
+        self._offsets.append(self._offsets[-1] + len(text))
+        _hash_chunk(self._digest, chunk)
+
+    def write_to(self, f: IO[bytes]):
+        """Escribe el almacén completo en un fichero binario abierto."""
+        sections, position = {}, 0
+        for name, length in (("offsets", len(self._offsets) * 8), ("source_ids", len(self._source_ids) * 2),
+                             ("parent_ids", len(self._parent_ids) * 4), ("point_ids", len(self._point_ids)),
+                             ("texts", self._offsets[-1])):
+            sections[name] = [position, length]
+            position += length + _pad(length)
+
+        header = json.dumps({
+            "version": FORMAT_VERSION,
+            "count": len(self),
+            "corpus_hash": self.corpus_hash,
+            "sources": self._source_names,
+            "sections": sections,
+        }).encode("utf-8")
+        header += b" " * _pad(len(MAGIC) + 8 + len(header))
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        # El formato es little-endian (como los arrays de 'array' en las plataformas soportadas)
+        for data in (self._offsets.tobytes(), self._source_ids.tobytes(),
+                     self._parent_ids.tobytes(), bytes(self._point_ids)):
+            f.write(data + b"\0" * _pad(len(data)))
+        self._texts.seek(0)
+        shutil.copyfileobj(self._texts, f)
+        f.write(b"\0" * _pad(self._offsets[-1]))
+
+    def save(self, filename: str):
+        """Escribe el almacén de forma atómica (los workers que ya lo tienen mapeado no ven un fichero a medias)."""
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "wb") as f:
+            self.write_to(f)
+        os.replace(tmp_filename, filename)
+
+    def close(self):
+        self._texts.close()
+
+
+def encode_chunk_store(chunks: Iterable[dict]) -> bytes:
+    """Serializa los chunks (dicts del fichero de ingesta) al formato binario."""
+    writer = ChunkStoreWriter()
+    for chunk in chunks:
+        writer.add(chunk)
+    buffer = io.BytesIO()
+    writer.write_to(buffer)
+    writer.close()
+    return buffer.getvalue()
+
+
+def write_chunk_store(chunks: Iterable[dict], filename: str):
+    """Escribe el almacén de forma atómica a partir de los chunks (pueden venir de un iterador)."""
+    writer = ChunkStoreWriter()
+    for chunk in chunks:
+        writer.add(chunk)
+    writer.save(filename)
+    writer.close()
+
+
+def read_corpus_hash(filename: str) -> str:
+    """Lee solo la cabecera del almacén y devuelve su hash del corpus."""
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("El fichero no es un almacén de chunks válido.")
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(header_len).decode("utf-8"))["corpus_hash"]
+
+
+class CorpusVersionWatcher:
+    """
+    Versión (hash) del corpus publicado en disco. Cada proceso abre el almacén una sola vez; esto
+    permite saber, sin reiniciar, que la ingesta lo ha regenerado. La cabecera solo se relee cuando
+    cambian la fecha de modificación o el tamaño del fichero.
+
+    Atributos:
+        loaded_hash: Hash del almacén que está usando el proceso.
+    """
+
+    def __init__(self, filename: str, loaded_hash: str):
+        self.filename = filename
+        self.loaded_hash = loaded_hash
+        self._stamp = None
+        self._hash = loaded_hash
+
+    def current(self) -> str:
+        """Hash del almacén en disco (el cargado si el fichero no existe)."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return self.loaded_hash
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp != self._stamp:
+            try:
+                self._hash = read_corpus_hash(self.filename)
+            except (OSError, ValueError, KeyError):
+                return self._hash
+            self._stamp = stamp
+        return self._hash
+
+    @property
+    def stale(self) -> bool:
+        """True si la ingesta ha publicado otro corpus desde que se cargó el almacén."""
+        return self.current() != self.loaded_hash
+
+
+class ChunkStore:
+    """
+    Acceso de solo lectura a los chunks por id global, sin parsear ni duplicar el corpus.
+
+    Atributos:
+        corpus_hash: Hash del corpus (ver compute_corpus_hash), usado para validar el índice BM25.
+        source_names: Lista con el nombre de cada fuente; source_ids[i] indexa esta lista.
+        source_ids: Array (N,) con el código de fuente de cada chunk.
+        parent_ids: Array (N,) con el 'parent_doc_index' de cada chunk.
+        point_ids: Array (N,) con el UUID (16 bytes) del punto de Qdrant de cada chunk.
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        view = memoryview(buffer)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError("El fichero no es un almacén de chunks válido.")
+        (header_len,) = struct.unpack_from("<Q", view, len(MAGIC))
+        data_start = len(MAGIC) + 8 + header_len
+        self.header = json.loads(bytes(view[len(MAGIC) + 8:data_start]).decode("utf-8"))
+        if self.header["version"] != FORMAT_VERSION:
+            raise ValueError(f"Versión de almacén de chunks no soportada: {self.header['version']}")
+
+        def section(name, dtype):
+            offset, length = self.header["sections"][name]
+            return np.frombuffer(buffer, dtype=dtype, count=length // np.dtype(dtype).itemsize,
+                                 offset=data_start + offset)
+
+        self._offsets = section("offsets", "<u8")
+        self.source_ids = section("source_ids", "<u2")
+        self.parent_ids = section("parent_ids", "<i4")
+        self.point_ids = section("point_ids", "S16")
+        self._point_index: Optional[Dict[str, int]] = None
+        self._texts_start = data_start + self.header["sections"]["texts"][0]
+        self._view = view
+        self.source_names: List[str] = self.header["sources"]
+        self.corpus_hash: str = self.header["corpus_hash"]
+
+    @classmethod
+    def open(cls, filename: str) -> "ChunkStore":
+        """Abre el almacén con mmap (las páginas se comparten entre todos los workers del host)."""
+        with open(filename, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped)
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[dict]) -> "ChunkStore":
+        """Construye el almacén en memoria (útil cuando solo se dispone del fichero de chunks)."""
+        return cls(encode_chunk_store(chunks))
+
+    def __len__(self) -> int:
+        return self.header["count"]
+
+    def text(self, chunk_id: int) -> str:
+        """Devuelve el 'contextualized_chunk' del chunk indicado."""
+        start = self._texts_start + int(self._offsets[chunk_id])
+        end = self._texts_start + int(self._offsets[chunk_id + 1])
+        return bytes(self._view[start:end]).decode("utf-8")
+
+    def texts(self, chunk_ids: Iterable[int]) -> List[str]:
+        return [self.text(chunk_id) for chunk_id in chunk_ids]
+
+    def point_id(self, chunk_id: int) -> str:
+        # numpy elimina los bytes nulos finales de los valores 'S16': se restauran con ljust
+        return str(uuid.UUID(bytes=bytes(self.point_ids[chunk_id]).ljust(16, b"\0")))
+
+    def chunk_id(self, point_id) -> Optional[int]:
+        """Id del chunk correspondiente a un punto de Qdrant (None si el punto no está en este corpus)."""
+        if self._point_index is None:
+            # Se construye la primera vez que se usa; si hay chunks idénticos gana el primero.
+            index: Dict[str, int] = {}
+            for position, raw in enumerate(self.point_ids.tolist()):
+                index.setdefault(str(uuid.UUID(bytes=raw.ljust(16, b"\0"))), position)
+            self._point_index = index
+        return self._point_index.get(str(point_id))
+
+    def source(self, chunk_id: int) -> str:
+        return self.source_names[self.source_ids[chunk_id]]
+
+    def sources(self) -> List[str]:
+        """Fuente de cada chunk, en orden de id (usado para particionar el índice BM25)."""
+        return [self.source_names[code] for code in self.source_ids.tolist()]
@@ -1,10 +1,21 @@
-import pickle
+import asyncio
 import json
 import sys
-from sentence_transformers import CrossEncoder
-from qdrant_client import QdrantClient
+from concurrent.futures import ThreadPoolExecutor
+from qdrant_client import AsyncQdrantClient
 from langchain_ollama import OllamaEmbeddings, ChatOllama
-from rank_bm25 import BM25Okapi
+from graph.admission import AdmissionControlled, AdmissionLimiter
+from graph.bm25 import build_partitioned_index, load_index
+from graph.answer_cache import AnswerCache
+from graph.chunk_io import iter_chunks
+from graph.chunk_store import ChunkStore, CorpusVersionWatcher
+from graph.embedding_cache import CachedEmbeddings
+from graph.onnx_reranker import OnnxCrossEncoder
+from graph.reranker_service import RerankerService
+from graph.resources import ResourceManager
+from graph.score_cache import RerankScoreCache
+from graph.selection import TokenCounter
+from graph.router import DEFAULT_EXAMPLES, CentroidRouter, HybridRouter
 import os # Necesario para las variables de entorno
 
 # BM25_INDEX_FILE = "bm25_index_unificado.pkl"
@@ -17,8 +28,11 @@ import os # Necesario para las variables de entorno
 # OLLAMA_ROUTING_MODEL = "llama3.1:latest"
 
 # --- Rutas de Ficheros (relativas al WORKDIR /app en Docker) ---
-BM25_INDEX_FILE = "bm25_index_unificado.pkl"
+BM25_INDEX_DIR = "bm25_index"
 ALL_CHUNKS_UNIFIED_FILE = "all_chunks_unificado.json"
+CHUNK_STORE_FILE = "chunk_store.bin"
+# Cada cuántos segundos se comprueba si la ingesta ha publicado otro corpus para recargarlo en caliente (0 = nunca)
+CORPUS_RELOAD_INTERVAL = float(os.getenv("CORPUS_RELOAD_INTERVAL", "30"))
 
 # --- Configuración de Qdrant ---
 # Leemos la URL del entorno. Usamos host.docker.internal como default para desarrollo local con Docker.
@@ -32,6 +46,77 @@ OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text:l
 OLLAMA_GENERATION_MODEL = os.getenv("OLLAMA_GENERATION_MODEL", "gpt-oss:20b")
 OLLAMA_ROUTING_MODEL = os.getenv("OLLAMA_ROUTING_MODEL", "llama3.1:latest")
 
+# --- Router de fuente de datos ---
+# ROUTER_MODE: 'hybrid' (reglas + clasificador local + LLM si la confianza es baja),
+# 'local' (nunca llama al LLM) o 'llm' (siempre el LLM, comportamiento original).
+ROUTER_MODE = os.getenv("ROUTER_MODE", "hybrid")
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.05"))
+ROUTER_EXAMPLES_FILE = os.getenv("ROUTER_EXAMPLES_FILE", "")
+
+# --- Reranker (CrossEncoder con micro-batching) ---
+# RERANKER_BACKEND: 'torch' (CrossEncoder fp32) u 'onnx' (modelo int8 exportado con desarrollo/6_reranker_onnx.py)
+RERANKER_MODEL_NAME = "cross-encoder/ms-marco-minilm-l-6-v2"
+RERANKER_BACKEND = os.getenv("RERANKER_BACKEND", "torch")
+RERANKER_ONNX_PATH = os.getenv("RERANKER_ONNX_PATH", "models/ms-marco-minilm-l-6-v2-int8.onnx")
+RERANKER_MAX_BATCH_SIZE = int(os.getenv("RERANKER_MAX_BATCH_SIZE", "64"))
+RERANKER_MAX_WAIT_MS = float(os.getenv("RERANKER_MAX_WAIT_MS", "5"))
+RERANKER_TORCH_THREADS = int(os.getenv("RERANKER_TORCH_THREADS", "0"))  # 0 = valor por defecto (torch u ONNX Runtime)
+RERANKER_CACHE_SIZE = int(os.getenv("RERANKER_CACHE_SIZE", "20000"))  # Entradas (pregunta, chunk) cacheadas
+
+# --- Memoria de conversaciones (checkpointer SQLite, ver graph/memory.py) ---
+MEMORY_DB = os.getenv("MEMORY_DB", "conversations.sqlite")
+MEMORY_TTL = float(os.getenv("MEMORY_TTL", str(7 * 86400)))  # Segundos de inactividad antes de expirar; 0 = nunca
+MEMORY_MAX_CHECKPOINTS = int(os.getenv("MEMORY_MAX_CHECKPOINTS", "3"))
+MEMORY_MAX_MESSAGES = int(os.getenv("MEMORY_MAX_MESSAGES", "20"))
+
+# --- Gestión del historial (ver graph/history.py) ---
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "3"))  # Turnos (pregunta + respuesta) que se conservan literalmente
+HISTORY_SUMMARY_EVERY = int(os.getenv("HISTORY_SUMMARY_EVERY", "2"))  # Turnos que se acumulan fuera de la ventana antes de resumir
+HISTORY_REWRITE = os.getenv("HISTORY_REWRITE", "true").lower() == "true"  # Reescribir preguntas de seguimiento
+
+# --- Control de admisión delante de Ollama (ver graph/admission.py) ---
+# Por modelo: llamadas simultáneas, peticiones en cola y segundos máximos de espera en la cola.
+GENERATOR_MAX_CONCURRENCY = int(os.getenv("GENERATOR_MAX_CONCURRENCY", "2"))
+GENERATOR_MAX_QUEUE = int(os.getenv("GENERATOR_MAX_QUEUE", "16"))
+GENERATOR_QUEUE_TIMEOUT = float(os.getenv("GENERATOR_QUEUE_TIMEOUT", "30"))
+ROUTER_MAX_CONCURRENCY = int(os.getenv("ROUTER_MAX_CONCURRENCY", "4"))
+ROUTER_MAX_QUEUE = int(os.getenv("ROUTER_MAX_QUEUE", "32"))
+ROUTER_QUEUE_TIMEOUT = float(os.getenv("ROUTER_QUEUE_TIMEOUT", "10"))
+EMBEDDER_MAX_CONCURRENCY = int(os.getenv("EMBEDDER_MAX_CONCURRENCY", "8"))
+EMBEDDER_MAX_QUEUE = int(os.getenv("EMBEDDER_MAX_QUEUE", "64"))
+EMBEDDER_QUEUE_TIMEOUT = float(os.getenv("EMBEDDER_QUEUE_TIMEOUT", "10"))
+
+# --- Ejecutores de hilos ---
+# COMENTARIO: Tamaño explícito de los pools para que un solo worker de uvicorn atienda muchas
+# conversaciones sin bloquear el event loop ni crear hilos sin límite.
+# CPU_WORKERS: pasos de cálculo de los nodos (BM25, tokenización del contexto).
+# IO_WORKERS: ejecutor por defecto del event loop (asyncio.to_thread, p. ej. la caché SQLite de embeddings).
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 2)))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "16"))
+
+# --- Selección adaptativa de candidatos (ver graph/selection.py) ---
+CANDIDATE_LIMIT = int(os.getenv("CANDIDATE_LIMIT", "20"))  # Resultados por cada búsqueda (densa y BM25)
+FUSION_METHOD = os.getenv("FUSION_METHOD", "rrf")  # 'rrf' o 'minmax' (scores normalizados por lista)
+RRF_K = int(os.getenv("RRF_K", "60"))
+FUSION_DENSE_WEIGHT = float(os.getenv("FUSION_DENSE_WEIGHT", "0.5"))  # Solo con 'minmax'; BM25 pesa 1 - este valor
+RERANK_MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", "16"))
+RERANK_SKIP_TOP = int(os.getenv("RERANK_SKIP_TOP", "3"))  # Candidatos que deben destacar para omitir el reranking
+RERANK_SKIP_MARGIN = float(os.getenv("RERANK_SKIP_MARGIN", "0.3"))  # Salto relativo de score RRF; >1 = reranquear siempre
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MAX_DOCUMENTS = int(os.getenv("CONTEXT_MAX_DOCUMENTS", "8"))
+GENERATOR_TOKENIZER = os.getenv("GENERATOR_TOKENIZER", "openai/gpt-oss-20b")  # Vacío = estimación por caracteres
+
+# --- Caché de embeddings de consultas ---
+# EMBEDDING_CACHE_DB activa el nivel en disco (SQLite) compartido entre workers; vacío = solo memoria.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", "")
+
+# --- Caché semántica de respuestas ---
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+
 # --- Instancias de Clientes y Modelos ---
 # Ahora tu código que usa estas variables será portable y configurable.
 # Por ejemplo:
@@ -39,21 +124,124 @@ OLLAMA_ROUTING_MODEL = os.getenv("OLLAMA_ROUTING_MODEL", "llama3.1:latest")
 # llm = ChatOllama(base_url=OLLAMA_BASE_URL, model=OLLAMA_GENERATION_MODEL)
 
 # --- 1. Cargar los recursos necesarios ---
-def load_resources():
-    print("Cargando recursos...")
-    bm25_index = pickle.load(open(BM25_INDEX_FILE, "rb"))
-    all_chunks_data = json.load(open(ALL_CHUNKS_UNIFIED_FILE, 'r', encoding='utf-8'))
-    bm25_corpus = [chunk['contextualized_chunk'] for chunk in all_chunks_data]
-    qdrant_client = QdrantClient(url=QDRANT_URL)
-    ollama_embeddings = OllamaEmbeddings(base_url=OLLAMA_BASE_URL, model=OLLAMA_EMBEDDING_MODEL)
-    llm_generator = ChatOllama(base_url=OLLAMA_BASE_URL, model=OLLAMA_GENERATION_MODEL, temperature=0)
-    llm_router = ChatOllama(base_url=OLLAMA_BASE_URL, model=OLLAMA_ROUTING_MODEL, temperature=0, format="json")
-    
-    # COMENTARIO: Volvemos a cargar el modelo reranker
-    reranker = CrossEncoder('cross-encoder/ms-marco-minilm-l-6-v2', max_length=512)
-    
-    print("Recursos cargados.")
-    return bm25_index, all_chunks_data, bm25_corpus, qdrant_client, ollama_embeddings, llm_generator, llm_router, reranker
-
-bm25_index, all_chunks_data, bm25_corpus, qdrant_client, ollama_embeddings, llm_generator, llm_router, reranker = load_resources()
+# COMENTARIO: Cada recurso se carga en su propio hilo al importar el módulo, sin bloquear el arranque de uvicorn.
+# Los nodos obtienen cada recurso con `resources.get(nombre)`, que solo espera por ese recurso.
+def load_chunk_store():
+    # COMENTARIO: El almacén binario se abre con mmap; el JSON solo se usa si aún no se ha generado.
+    if os.path.exists(CHUNK_STORE_FILE):
+        return ChunkStore.open(CHUNK_STORE_FILE)
+    print(f"No se encontró '{CHUNK_STORE_FILE}', construyendo el almacén desde '{ALL_CHUNKS_UNIFIED_FILE}'...")
+    return ChunkStore.from_chunks(iter_chunks(ALL_CHUNKS_UNIFIED_FILE))
+
+def load_bm25_index():
+    return open_bm25_index(resources.get("chunk_store"))
+
+def open_bm25_index(chunk_store: ChunkStore):
+    # COMENTARIO: Formato versionado (arrays .npy abiertos con mmap). Si el índice no corresponde
+    # al almacén de chunks se lanza StaleIndexError y el recurso queda en error (/ready devuelve 503).
+    if os.path.exists(BM25_INDEX_DIR):
+        return load_index(BM25_INDEX_DIR, expected_corpus_hash=chunk_store.corpus_hash)
+
+    # Sin índice en disco se construye en memoria a partir del almacén de chunks.
+    print(f"No se encontró '{BM25_INDEX_DIR}', construyendo el índice BM25 en memoria...")
+    return build_partitioned_index((chunk_store.text(i) for i in range(len(chunk_store))), chunk_store.sources())
+
+def load_embeddings():
+    # COMENTARIO: Las consultas repetidas se sirven desde la caché sin llamar a Ollama.
+    # Solo los fallos de caché llegan a Ollama, y pasan por el control de admisión.
+    return CachedEmbeddings(
+        AdmissionControlled(OllamaEmbeddings(base_url=OLLAMA_BASE_URL, model=OLLAMA_EMBEDDING_MODEL), limiters["embedder"]),
+        model_name=OLLAMA_EMBEDDING_MODEL,
+        maxsize=EMBEDDING_CACHE_SIZE,
+        ttl=EMBEDDING_CACHE_TTL,
+        disk_path=EMBEDDING_CACHE_DB or None,
+    )
+
+def load_router():
+    embeddings = resources.get("ollama_embeddings")
+    classifier = None
+    if ROUTER_MODE != "llm":
+        examples = DEFAULT_EXAMPLES
+        if ROUTER_EXAMPLES_FILE:
+            with open(ROUTER_EXAMPLES_FILE, 'r', encoding='utf-8') as f:
+                examples = json.load(f)
+        try:
+            classifier = CentroidRouter(embeddings).fit(examples)
+        except Exception as e:
+            # Sin clasificador el router sigue funcionando con reglas y LLM.
+            print(f"No se pudo entrenar el clasificador del router: {e}")
+    return HybridRouter(llm=resources.get("llm_router"), embeddings=embeddings, classifier=classifier,
+                        min_confidence=ROUTER_MIN_CONFIDENCE, mode=ROUTER_MODE)
+
+def load_reranker():
+    if RERANKER_BACKEND == "onnx":
+        model = OnnxCrossEncoder(RERANKER_ONNX_PATH, RERANKER_MODEL_NAME, max_length=512,
+                                 intra_op_threads=RERANKER_TORCH_THREADS)
+    else:
+        # El import de sentence_transformers (torch) es lento, por eso se hace dentro del hilo de carga.
+        from sentence_transformers import CrossEncoder
+        model = CrossEncoder(RERANKER_MODEL_NAME, max_length=512)
+    # COMENTARIO: Las peticiones concurrentes se agrupan en lotes en un único hilo de inferencia
+    return RerankerService(model, max_batch_size=RERANKER_MAX_BATCH_SIZE, max_wait_ms=RERANKER_MAX_WAIT_MS,
+                           backend=RERANKER_BACKEND, torch_threads=RERANKER_TORCH_THREADS or None)
+
+limiters = {
+    "router": AdmissionLimiter("router", ROUTER_MAX_CONCURRENCY, ROUTER_MAX_QUEUE, ROUTER_QUEUE_TIMEOUT),
+    "embedder": AdmissionLimiter("embedder", EMBEDDER_MAX_CONCURRENCY, EMBEDDER_MAX_QUEUE, EMBEDDER_QUEUE_TIMEOUT),
+    "generator": AdmissionLimiter("generator", GENERATOR_MAX_CONCURRENCY, GENERATOR_MAX_QUEUE, GENERATOR_QUEUE_TIMEOUT),
+}
+
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+resources = ResourceManager()
+resources.register("chunk_store", load_chunk_store)
+resources.register("corpus_version", lambda: CorpusVersionWatcher(CHUNK_STORE_FILE, resources.get("chunk_store").corpus_hash))
+resources.register("bm25_index", load_bm25_index)
+resources.register("async_qdrant_client", lambda: AsyncQdrantClient(url=QDRANT_URL))
+resources.register("ollama_embeddings", load_embeddings)
+resources.register("llm_generator", lambda: AdmissionControlled(
+    ChatOllama(base_url=OLLAMA_BASE_URL, model=OLLAMA_GENERATION_MODEL, temperature=0), limiters["generator"]))
+resources.register("llm_router", lambda: AdmissionControlled(
+    ChatOllama(base_url=OLLAMA_BASE_URL, model=OLLAMA_ROUTING_MODEL, temperature=0, format="json"), limiters["router"]))
+# El resumen del historial y la reescritura de preguntas usan el modelo de routing (sin formato JSON)
+resources.register("llm_history", lambda: AdmissionControlled(
+    ChatOllama(base_url=OLLAMA_BASE_URL, model=OLLAMA_ROUTING_MODEL, temperature=0), limiters["router"]))
+resources.register("router", load_router)
+resources.register("reranker", load_reranker)
+resources.register("rerank_cache", lambda: RerankScoreCache(maxsize=RERANKER_CACHE_SIZE))
+resources.register("generator_tokenizer", lambda: TokenCounter(GENERATOR_TOKENIZER))
+resources.register("answer_cache", lambda: AnswerCache(threshold=ANSWER_CACHE_THRESHOLD, maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL))
+
+# --- Recarga en caliente del corpus ---
+# COMENTARIO: La ingesta reescribe chunk_store.bin y bm25_index/ y cambia los ids de Qdrant. Sin recargar,
+# el backend seguiría con el almacén antiguo y descartaría los resultados densos con ids nuevos.
+def load_published_corpus():
+    """Abre el almacén y el índice BM25 publicados. Falla (StaleIndexError) si la ingesta aún no ha escrito el índice."""
+    chunk_store = ChunkStore.open(CHUNK_STORE_FILE)
+    return chunk_store, open_bm25_index(chunk_store)
+
+async def watch_corpus(interval: float = CORPUS_RELOAD_INTERVAL):
+    """Comprueba periódicamente la versión del corpus en disco y, si ha cambiado, recarga el almacén y BM25."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not (await resources.aget("corpus_version")).stale:
+                continue
+            chunk_store, bm25_index = await asyncio.to_thread(load_published_corpus)
+        except Exception as e:
+            print(f"No se pudo recargar el corpus, se reintentará: {type(e).__name__}: {e}")
+            continue
+        # Todo se sustituye a la vez y sin await entre medias. Los scores del reranker van por id de chunk,
+        # que cambian con el corpus, así que su caché empieza de cero; la de respuestas descarta sola las
+        # entradas del corpus anterior.
+        resources.replace({
+            "chunk_store": chunk_store,
+            "bm25_index": bm25_index,
+            "corpus_version": CorpusVersionWatcher(CHUNK_STORE_FILE, chunk_store.corpus_hash),
+            "rerank_cache": RerankScoreCache(maxsize=RERANKER_CACHE_SIZE),
+        })
+        print(f"Corpus recargado: {len(chunk_store)} chunks (hash {chunk_store.corpus_hash[:12]}).")
 
+print("Cargando recursos en segundo plano...")
+resources.start()
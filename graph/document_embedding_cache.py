@@ -0,0 +1,138 @@
+# graph/document_embedding_cache.py
+# Caché persistente de embeddings de documentos para la ingesta (ingest.py y desarrollo/4_index_data.py).
+# Clave: (nombre del modelo, hash del texto). Cada modelo tiene su propio directorio con:
+#   meta.json     dimensión y tipo (float32 o float16) de los vectores
+#   keys.bin      hash blake2b de 16 bytes de cada texto, en orden de fila
+#   vectors.bin   matriz de vectores (una fila por texto) que se lee con np.memmap
+# Los ficheros solo crecen (se añaden filas al final). Un reindexado con el mismo contenido y el
+# mismo modelo no llama a Ollama: todos los vectores salen del fichero mapeado.
+# Pensado para un único proceso escritor (la ingesta); es seguro entre hilos.
+
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+_KEY_BYTES = 16
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=_KEY_BYTES).digest()
+
+
+class MmapEmbeddingStore:
+    """
+    Atributos:
+        directory: Directorio de este modelo dentro del directorio de la caché.
+        dtype: Tipo de los vectores en disco ('float32' sin pérdida respecto a Qdrant, 'float16' ocupa la mitad).
+        dim: Dimensión de los vectores (se fija con el primer vector guardado).
+    """
+
+    def __init__(self, directory: str, model_name: str, dtype: str = "float32"):
+        self.directory = os.path.join(directory, re.sub(r"[^\w.-]+", "_", model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self._meta_path = os.path.join(self.directory, "meta.json")
+        self._keys_path = os.path.join(self.directory, "keys.bin")
+        self._vectors_path = os.path.join(self.directory, "vectors.bin")
+        self.dtype = np.dtype(dtype)
+        self.dim: Optional[int] = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            # El tipo con el que se creó la caché manda sobre el solicitado
+            self.dtype, self.dim = np.dtype(meta["dtype"]), meta["dim"]
+        self._lock = threading.Lock()
+        self._index: Dict[bytes, int] = {}
+        self._rows = 0
+        self._vectors: Optional[np.memmap] = None
+        self._load()
+
+    def _row_bytes(self) -> int:
+        return self.dim * self.dtype.itemsize
+
+    def _load(self):
+        if self.dim is None or not os.path.exists(self._keys_path) or not os.path.exists(self._vectors_path):
+            return
+        with open(self._keys_path, "rb") as f:
+            keys = f.read()
+        rows = min(len(keys) // _KEY_BYTES, os.path.getsize(self._vectors_path) // self._row_bytes())
+        # Si una ejecución anterior se interrumpió a mitad de una escritura, se descarta la fila incompleta.
+        os.truncate(self._keys_path, rows * _KEY_BYTES)
+        os.truncate(self._vectors_path, rows * self._row_bytes())
+        self._index = {keys[row * _KEY_BYTES:(row + 1) * _KEY_BYTES]: row for row in range(rows)}
+        self._rows = rows
+
+    def _matrix(self) -> np.memmap:
+        if self._vectors is None or len(self._vectors) != self._rows:
+            self._vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode="r", shape=(self._rows, self.dim))
+        return self._vectors
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Vector de cada texto, o None si no está en la caché."""
+        with self._lock:
+            rows = [self._index.get(text_key(text)) for text in texts]
+            if self._rows == 0:
+                return [None] * len(texts)
+            matrix = self._matrix()
+            return [None if row is None else matrix[row].astype(np.float32).tolist() for row in rows]
+
+    def put_many(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        with self._lock:
+            new_keys, new_vectors = [], []
+            for text, vector in zip(texts, vectors):
+                key = text_key(text)
+                if key in self._index:
+                    continue
+                self._index[key] = self._rows + len(new_keys)
+                new_keys.append(key)
+                new_vectors.append(vector)
+            if not new_keys:
+                return
+            matrix = np.asarray(new_vectors, dtype=self.dtype)
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype.name}, f)
+            # Primero los vectores y después las claves: una clave nunca apunta a una fila sin escribir.
+            with open(self._vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(self._keys_path, "ab") as f:
+                f.write(b"".join(new_keys))
+            self._rows += len(new_keys)
+
+
+class CachedDocumentEmbeddings:
+    """
+    Envoltorio de un modelo de embeddings de LangChain que sirve embed_documents desde un
+    MmapEmbeddingStore y solo envía al modelo los textos que no están en la caché.
+    """
+
+    def __init__(self, embeddings, store: MmapEmbeddingStore):
+        self.embeddings = embeddings
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.store.get_many(texts)
+        missing = [position for position, vector in enumerate(vectors) if vector is None]
+        if missing:
+            new_vectors = self.embeddings.embed_documents([texts[position] for position in missing])
+            self.store.put_many([texts[position] for position in missing], new_vectors)
+            for position, vector in zip(missing, new_vectors):
+                vectors[position] = vector
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return vectors
@@ -0,0 +1,125 @@
+# graph/embedding_cache.py
+# Caché de embeddings de consultas delante de OllamaEmbeddings.embed_query.
+# Nivel 1: LRU en memoria con TTL (por proceso). Nivel 2 (opcional): SQLite en disco,
+# compartido entre workers y persistente entre reinicios. La clave incluye el nombre del
+# modelo de embeddings, así que cambiar de modelo invalida la caché automáticamente.
+
+import asyncio
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import List, Optional
+
+import numpy as np
+
+from graph.cache import LRUCache
+
+
+def normalize_question(text: str) -> str:
+    """Normaliza la pregunta para que variaciones triviales (mayúsculas, espacios) compartan entrada."""
+    return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+class SqliteEmbeddingStore:
+    """Nivel en disco: vectores float32 en una tabla SQLite (modo WAL, seguro entre procesos)."""
+
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            " model TEXT NOT NULL, key TEXT NOT NULL, vector BLOB NOT NULL, created_at REAL NOT NULL,"
+            " PRIMARY KEY (model, key))"
+        )
+        self._conn.commit()
+
+    def get(self, model: str, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, created_at FROM query_embeddings WHERE model = ? AND key = ?", (model, key)
+            ).fetchone()
+        if row is None:
+            return None
+        vector, created_at = row
+        if self.ttl and created_at + self.ttl < time.time():
+            return None
+        return np.frombuffer(vector, dtype=np.float32).tolist()
+
+    def set(self, model: str, key: str, vector: List[float]):
+        blob = np.asarray(vector, dtype=np.float32).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (model, key, vector, created_at) VALUES (?, ?, ?, ?)",
+                (model, key, blob, time.time()),
+            )
+            self._conn.commit()
+
+
+class CachedEmbeddings:
+    """
+    Envoltorio de un modelo de embeddings de LangChain que cachea embed_query / aembed_query.
+    El resto de métodos (embed_documents...) se delegan sin caché.
+    """
+
+    def __init__(self, embeddings, model_name: str, maxsize: int = 2048, ttl: Optional[float] = 3600,
+                 disk_path: Optional[str] = None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.disk = SqliteEmbeddingStore(disk_path, ttl=ttl) if disk_path else None
+        self.disk_hits = 0
+
+    def __getattr__(self, name):
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        vector = self.memory.get((self.model_name, key))
+        if vector is None and self.disk is not None:
+            vector = self._lookup_disk(key)
+        return vector
+
+    def _lookup_disk(self, key: str) -> Optional[List[float]]:
+        vector = self.disk.get(self.model_name, key)
+        if vector is not None:
+            self.disk_hits += 1
+            self.memory.set((self.model_name, key), vector)
+        return vector
+
+    def _store(self, key: str, vector: List[float]):
+        self.memory.set((self.model_name, key), vector)
+        if self.disk is not None:
+            self.disk.set(self.model_name, key, vector)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = normalize_question(text)
+        vector = self._lookup(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = normalize_question(text)
+        # El nivel en memoria se consulta en el propio event loop; solo SQLite (síncrono) va a un hilo.
+        vector = self.memory.get((self.model_name, key))
+        if vector is None and self.disk is not None:
+            vector = await asyncio.to_thread(self._lookup_disk, key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            self.memory.set((self.model_name, key), vector)
+            if self.disk is not None:
+                await asyncio.to_thread(self.disk.set, self.model_name, key, vector)
+        return vector
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        # Los aciertos en disco cuentan como fallos del nivel en memoria.
+        stats["disk_hits"] = self.disk_hits
+        stats["model"] = self.model_name
+        return stats
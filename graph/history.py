@@ -0,0 +1,79 @@
+# graph/history.py
+# Gestión del historial de la conversación para acotar el tamaño de los prompts:
+#   - Se conservan literalmente los últimos turnos (ventana).
+#   - Los turnos anteriores se condensan en un resumen acumulado.
+#   - Las preguntas de seguimiento ("¿y en el plan de 1990?") se reescriben como preguntas
+#     autónomas, que son las que usan el router, la búsqueda, las cachés y el generador.
+
+import re
+from typing import Sequence
+
+from langchain_core.messages import BaseMessage, HumanMessage
+
+from graph.analyzer import fold_text
+
+# Indicios de que una pregunta depende de la conversación: demostrativos, pronombres de referencia,
+# pronombres enclíticos ("contabilizarlo") y arranques de seguimiento ("¿y en el plan de 1990?").
+_FOLLOW_UP = re.compile(r"^\W*(y|entonces|tambien|pero)\b"
+                        r"|\b(est[eoa]s?|es[eoa]s?|aquel(l[oa]s?)?|ello|dich[oa]s?|mism[oa]s?|anterior(es)?|otr[oa]s?)\b"
+                        r"|\b\w+(ar|er|ir|ando|endo)(l[oa]s?|les?)\b")
+_SHORT_QUESTION_WORDS = 5  # Las preguntas muy cortas suelen omitir el tema ("¿cómo se amortiza?")
+
+SUMMARY_PROMPT = """
+    Resume de forma concisa la siguiente conversación entre un usuario y un asistente de contabilidad.
+    Conserva los temas consultados, las cuentas, normas y planes contables mencionados y las conclusiones.
+    Si hay un resumen previo, intégralo en el nuevo resumen.
+
+    RESUMEN PREVIO:
+    {summary}
+
+    CONVERSACIÓN:
+    {history}
+
+    Responde únicamente con el resumen.
+    """
+
+REWRITE_PROMPT = """
+    Dada la conversación previa y una pregunta de seguimiento, reescribe la pregunta para que se entienda
+    por sí sola, sin la conversación (sustituye pronombres y referencias implícitas por lo que designan).
+    Si ya se entiende por sí sola, devuélvela sin cambios. No respondas a la pregunta.
+
+    RESUMEN DE LA CONVERSACIÓN:
+    {summary}
+
+    ÚLTIMOS MENSAJES:
+    {history}
+
+    PREGUNTA DE SEGUIMIENTO: {question}
+
+    Responde únicamente con la pregunta reescrita.
+    """
+
+
+def format_history(messages: Sequence[BaseMessage]) -> str:
+    """Historial en texto plano, una línea por mensaje con su rol."""
+    lines = []
+    for message in messages:
+        role = "Usuario" if isinstance(message, HumanMessage) else "Asistente"
+        lines.append(f"{role}: {message.content}")
+    return "\n".join(lines)
+
+
+def needs_rewrite(question: str) -> bool:
+    """Heurística barata: solo se reescriben las preguntas que parecen depender del contexto."""
+    text = fold_text(question)
+    return len(text.split()) <= _SHORT_QUESTION_WORDS or bool(_FOLLOW_UP.search(text))
+
+
+async def summarize(llm, summary: str, messages: Sequence[BaseMessage]) -> str:
+    """Integra 'messages' en el resumen acumulado."""
+    response = await llm.ainvoke(SUMMARY_PROMPT.format(summary=summary or "(ninguno)",
+                                                       history=format_history(messages)))
+    return response.content.strip()
+
+
+async def rewrite_question(llm, question: str, summary: str, messages: Sequence[BaseMessage]) -> str:
+    """Pregunta autónoma a partir de una pregunta de seguimiento; si la respuesta está vacía, la original."""
+    response = await llm.ainvoke(REWRITE_PROMPT.format(summary=summary or "(ninguno)",
+                                                       history=format_history(messages), question=question))
+    return response.content.strip().strip('"') or question
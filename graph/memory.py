@@ -1,3 +1,295 @@
-from langgraph.checkpoint.memory import MemorySaver
+# graph/memory.py
+# Checkpointer de LangGraph persistente y acotado, sobre SQLite (sustituye a MemorySaver).
+# - Persistente y compartido entre workers de uvicorn: SQLite en modo WAL, con busy timeout y
+#   escrituras en transacciones BEGIN IMMEDIATE.
+# - Acotado: por conversación se guardan solo los últimos 'max_checkpoints' checkpoints, y el
+#   historial de mensajes se recorta a los últimos 'max_messages' (empezando por una pregunta).
+# - TTL: las conversaciones sin actividad durante 'ttl' segundos se ignoran al leer y se borran
+#   periódicamente.
+# - Serialización compacta: el serializador de LangGraph (msgpack) para checkpoints y escrituras.
+
+import asyncio
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT,
+    value BLOB,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE INDEX IF NOT EXISTS threads_updated_at ON threads (updated_at);
+"""
+
+
+class SqliteCheckpointer(BaseCheckpointSaver):
+    """
+    Atributos:
+        path: Fichero SQLite (puede compartirse entre procesos).
+        ttl: Segundos de inactividad tras los que una conversación expira (0 = nunca).
+        max_checkpoints: Checkpoints que se conservan por conversación.
+        max_messages: Mensajes que se conservan en el historial de cada conversación (0 = todos).
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 86400, max_checkpoints: int = 3, max_messages: int = 20,
+                 sweep_interval: float = 300):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self.max_checkpoints = max(max_checkpoints, 1)
+        self.max_messages = max_messages
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        # isolation_level=None: las transacciones se abren explícitamente en _transaction().
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction() as conn:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Transacción de escritura; BEGIN IMMEDIATE toma el bloqueo al empezar (seguro entre procesos)."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql: str, params: Sequence[Any] = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _is_expired(self, thread_id: str) -> bool:
+        if not self.ttl:
+            return False
+        rows = self._query("SELECT updated_at FROM threads WHERE thread_id = ?", (thread_id,))
+        return bool(rows) and rows[0][0] + self.ttl < time.time()
+
+    def _trim_messages(self, checkpoint: Checkpoint) -> Checkpoint:
+        """Recorta el historial a los últimos max_messages mensajes, empezando por una pregunta del usuario."""
+        messages = checkpoint["channel_values"].get("messages")
+        if not self.max_messages or not messages or len(messages) <= self.max_messages:
+            return checkpoint
+        window = list(messages[-self.max_messages:])
+        start = next((i for i, message in enumerate(window) if isinstance(message, HumanMessage)), 0)
+        return {**checkpoint, "channel_values": {**checkpoint["channel_values"], "messages": window[start:]}}
+
+    def _load_tuple(self, thread_id: str, checkpoint_ns: str, row: Tuple) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        writes = self._query(
+            "SELECT task_id, channel, type, value FROM writes"
+            " WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        )
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                     "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                  "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((wtype, value)))
+                            for task_id, channel, wtype, value in writes],
+        )
+
+    # --- Interfaz de BaseCheckpointSaver ---
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        if self._is_expired(thread_id):
+            return None
+        columns = "checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+        if checkpoint_id := get_checkpoint_id(config):
+            rows = self._query(
+                f"SELECT {columns} FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            )
+        else:
+            rows = self._query(
+                f"SELECT {columns} FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+                " ORDER BY checkpoint_id DESC LIMIT 1",
+                (thread_id, checkpoint_ns),
+            )
+        return self._load_tuple(thread_id, checkpoint_ns, rows[0]) if rows else None
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        conditions, params = [], []
+        if config is not None:
+            conditions.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                conditions.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before is not None and (before_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id < ?")
+            params.append(before_id)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._query(
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint,"
+            f" metadata_type, metadata FROM checkpoints{where} ORDER BY checkpoint_id DESC",
+            params,
+        )
+        returned = 0
+        for thread_id, checkpoint_ns, *row in rows:
+            if self._is_expired(thread_id):
+                continue
+            checkpoint_tuple = self._load_tuple(thread_id, checkpoint_ns, tuple(row))
+            if filter and any(checkpoint_tuple.metadata.get(key) != value for key, value in filter.items()):
+                continue
+            yield checkpoint_tuple
+            returned += 1
+            if limit is not None and returned >= limit:
+                break
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        type_, serialized = self.serde.dumps_typed(self._trim_messages(checkpoint))
+        metadata_type, serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,"
+                " type, checkpoint, metadata_type, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                 type_, serialized, metadata_type, serialized_metadata),
+            )
+            conn.execute("INSERT OR REPLACE INTO threads (thread_id, updated_at) VALUES (?, ?)",
+                         (thread_id, time.time()))
+            # COMENTARIO: Solo se conservan los últimos max_checkpoints de la conversación (y sus escrituras)
+            kept = ("SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+                    " ORDER BY checkpoint_id DESC LIMIT ?")
+            for table in ("checkpoints", "writes"):
+                conn.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ({kept})",
+                    (thread_id, checkpoint_ns, thread_id, checkpoint_ns, self.max_checkpoints),
+                )
+        if time.time() - self._last_sweep > self.sweep_interval:
+            self.sweep()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                 "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # Las escrituras especiales (errores, interrupciones) reemplazan; el resto no se duplica.
+        verb = "INSERT OR REPLACE" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "INSERT OR IGNORE"
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, serialized = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx),
+                         channel, type_, serialized, task_path))
+        with self._transaction() as conn:
+            conn.executemany(
+                f"{verb} INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value,"
+                " task_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._transaction() as conn:
+            for table in ("checkpoints", "writes", "threads"):
+                conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    # Las versiones asíncronas ejecutan las operaciones de SQLite en el ejecutor por defecto.
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        checkpoint_tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint_tuple in checkpoint_tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    # --- Mantenimiento ---
+    def sweep(self) -> int:
+        """Borra las conversaciones inactivas más de ttl segundos. Devuelve cuántas se han borrado."""
+        self._last_sweep = time.time()
+        if not self.ttl:
+            return 0
+        expired = "SELECT thread_id FROM threads WHERE updated_at < ?"
+        cutoff = time.time() - self.ttl
+        with self._transaction() as conn:
+            for table in ("checkpoints", "writes"):
+                conn.execute(f"DELETE FROM {table} WHERE thread_id IN ({expired})", (cutoff,))
+            deleted = conn.execute("DELETE FROM threads WHERE updated_at < ?", (cutoff,)).rowcount
+        return deleted
+
+    def stats(self) -> Dict:
+        threads = self._query("SELECT COUNT(*) FROM threads")[0][0]
+        checkpoints = self._query("SELECT COUNT(*) FROM checkpoints")[0][0]
+        return {"threads": threads, "checkpoints": checkpoints, "ttl": self.ttl,
+                "max_checkpoints": self.max_checkpoints, "max_messages": self.max_messages}
+
+
 def get_memory():
-    return MemorySaver()
\ No newline at end of file
+    # COMENTARIO: Antes MemorySaver (en RAM, sin límite y por proceso); ahora SQLite persistente y acotado.
+    from graph.config import MEMORY_DB, MEMORY_TTL, MEMORY_MAX_CHECKPOINTS, MEMORY_MAX_MESSAGES
+    return SqliteCheckpointer(MEMORY_DB, ttl=MEMORY_TTL, max_checkpoints=MEMORY_MAX_CHECKPOINTS,
+                              max_messages=MEMORY_MAX_MESSAGES)
@@ -1,116 +1,250 @@
+import asyncio
 import textwrap
+from functools import partial
 from qdrant_client import QdrantClient, models
-import json
-from typing import Literal
-from langchain_core.messages import BaseMessage, AIMessage, HumanMessage
+from typing import List, Literal, Union
+from langchain_core.messages import BaseMessage, AIMessage, HumanMessage, RemoveMessage
+from langchain_core.runnables import RunnableConfig
 from graph.state import RagGraphState
-from graph.config import (bm25_corpus, bm25_index, all_chunks_data, ollama_embeddings,qdrant_client, QDRANT_COLLECTION_NAME,   llm_router, llm_generator, reranker)
+from graph.config import (resources, cpu_executor, QDRANT_COLLECTION_NAME, HISTORY_MAX_TURNS, HISTORY_SUMMARY_EVERY, HISTORY_REWRITE, CANDIDATE_LIMIT, FUSION_METHOD, RRF_K, FUSION_DENSE_WEIGHT,
+                          RERANK_MAX_CANDIDATES, RERANK_SKIP_TOP, RERANK_SKIP_MARGIN, CONTEXT_TOKEN_BUDGET,
+                          CONTEXT_MAX_DOCUMENTS)
+from graph.admission import OverloadedError
+from graph.analyzer import analyzer
+from graph.history import format_history, needs_rewrite, rewrite_question, summarize
+from graph.selection import normalized_score_fusion, reciprocal_rank_fusion, rerank_cutoff, select_by_token_budget
+
+# Correspondencia entre la decisión del router y el campo 'source' de los chunks
+SOURCE_MAP = {"legacy": "PGC_1990", "actual": "PGC_actual"}
 
 # --- 3. Definir los Nodos del Grafo ---
-def route_question(state: RagGraphState) -> RagGraphState:
-    print("---(Nodo: Clasificando Pregunta)---")
-    # Lee la pregunta del último mensaje
-    question = state["messages"][-1].content
-    routing_prompt = f"""
-    Tu tarea es clasificar la pregunta de un usuario sobre contabilidad para determinar qué base de conocimiento consultar.
-    Las opciones son:
-    - 'legacy': para preguntas sobre el Plan General Contable de 1990.
-    - 'actual': para preguntas sobre el Plan General Contable vigente (post-2007).
-    - 'both': para preguntas que comparan ambos planes o preguntan sobre su evolución.
+# COMENTARIO: Todos los nodos son async. La E/S usa los clientes asíncronos (Ollama, Qdrant) y los pasos
+# de CPU se envían a cpu_executor, de tamaño fijo; nunca se bloquea el event loop esperando un recurso.
+async def run_cpu(func, *args, **kwargs):
+    """Ejecuta una función de CPU en el pool 'cpu_executor' y espera su resultado sin bloquear."""
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, partial(func, *args, **kwargs))
 
-    Pregunta del usuario: "{question}"
+# COMENTARIO: Primer nodo del grafo. Mantiene acotado el historial y fija la pregunta autónoma
+# ('question') que usan el resto de nodos en lugar del último mensaje.
+async def manage_history(state: RagGraphState) -> RagGraphState:
+    """Resume los turnos antiguos y reescribe la pregunta de seguimiento como pregunta autónoma."""
+    print("---(Nodo: Gestionando Historial)---")
+    messages = list(state["messages"])
+    question = messages[-1].content
+    previous = messages[:-1]
+    summary = state.get("summary", "")
+    if not previous and not summary:
+        return {"question": question, "summary": ""}
 
-    Analiza la pregunta y responde únicamente con un objeto JSON con la clave "datasource" y uno de los tres valores: "legacy", "actual", o "both".
-    """
+    window = 2 * HISTORY_MAX_TURNS
+    recent = previous[-window:] if window else []
+    older = previous[:len(previous) - len(recent)]
+    llm = await resources.aget("llm_history")
+    update = {}
     try:
-        response = llm_router.invoke(routing_prompt)
-        router_output = json.loads(response.content)
-        datasource = router_output.get("datasource", "actual")
-    except (json.JSONDecodeError, AttributeError):
-        datasource = "actual"
-
-    print(f"Decisión del Router: {datasource}")
-    return {"datasource": datasource}
-
-def retrieve_documents(state: RagGraphState) -> RagGraphState:
-    print(f"---(Nodo: Recuperando Documentos de '{state['datasource']}')---")
-    # Lee la pregunta del último mensaje
+        # Los turnos que salen de la ventana se resumen por bloques de HISTORY_SUMMARY_EVERY turnos
+        if older and len(older) >= 2 * HISTORY_SUMMARY_EVERY:
+            summary = await summarize(llm, summary, older)
+            update["messages"] = [RemoveMessage(id=message.id) for message in older]
+            print(f"Historial resumido: {len(older)} mensajes")
+            context = recent
+        else:
+            context = previous
+        # La reescritura va después del resumen para ver también los turnos recién plegados en él
+        if HISTORY_REWRITE and needs_rewrite(question):
+            question = await rewrite_question(llm, question, summary, context)
+    except OverloadedError as e:
+        # Sin resumen ni reescritura se sigue con la pregunta original
+        print(f"No se pudo procesar el historial: {e}")
+    print(f"Pregunta autónoma: {question}")
+    return {**update, "question": question, "summary": summary}
+
+async def route_question(state: RagGraphState) -> RagGraphState:
+    print("---(Nodo: Clasificando Pregunta)---")
+    question = state["question"]
+    # COMENTARIO: Reglas y clasificador local primero; el LLM solo si la confianza es baja
+    router = await resources.aget("router")
+    decision = await router.aroute(question)
+
+    print(f"Decisión del Router: {decision.datasource} (por {decision.decided_by}, confianza {decision.confidence:.2f})")
+    return {"datasource": decision.datasource, "route_decided_by": decision.decided_by}
+
+# COMENTARIO: Caché semántica de respuestas. Se consulta justo después del router para que las
+# entradas queden acotadas por fuente de datos (y por versión del corpus).
+# La versión se toma del almacén en disco: cuando la ingesta lo regenera, las entradas anteriores se
+# descartan en la siguiente consulta, sin esperar a reiniciar el proceso.
+async def _cached_answer(question: str, datasource: Union[str, None]) -> Union[str, None]:
+    ollama_embeddings = await resources.aget("ollama_embeddings")
+    question_vector = await ollama_embeddings.aembed_query(question)
+    corpus_version = (await resources.aget("corpus_version")).current()
+    return (await resources.aget("answer_cache")).lookup(question_vector, datasource, corpus_version)
+
+# COMENTARIO: Primera consulta, antes del historial, con la pregunta tal como llega. Solo para preguntas
+# que no dependen de la conversación: como no se reescribirían, el acierto se sirve sin pagar las
+# llamadas al LLM de reescritura y del router. Se acepta cualquier fuente de datos porque el router
+# decidiría la misma para la misma pregunta.
+async def lookup_raw_cached_answer(state: RagGraphState) -> RagGraphState:
+    """Consulta la caché con la pregunta original si se entiende por sí sola."""
+    print("---(Nodo: Consultando Caché de Respuestas con la Pregunta Original)---")
     question = state["messages"][-1].content
+    if needs_rewrite(question):
+        return {"cache_hit": False}
+    answer = await _cached_answer(question, None)
+    if answer is None:
+        return {"cache_hit": False}
+    print("Respuesta encontrada en caché.")
+    return {"cache_hit": True, "question": question, "messages": [AIMessage(content=answer)]}
+
+async def raw_answer_cached(state: RagGraphState) -> Literal["hit", "miss"]:
+    """Con acierto en caché termina; si no, sigue por el historial."""
+    return "hit" if state.get("cache_hit") else "miss"
+
+async def lookup_cached_answer(state: RagGraphState) -> RagGraphState:
+    """Si una pregunta casi idéntica ya se respondió, devuelve esa respuesta y el grafo termina."""
+    print("---(Nodo: Consultando Caché de Respuestas)---")
+    answer = await _cached_answer(state["question"], state["datasource"])
+    if answer is None:
+        return {"cache_hit": False}
+    print("Respuesta encontrada en caché.")
+    return {"cache_hit": True, "messages": [AIMessage(content=answer)]}
+
+async def store_cached_answer(state: RagGraphState) -> RagGraphState:
+    """Guarda la respuesta generada en la caché semántica."""
+    question = state["question"]
+    corpus_version = await resources.aget("corpus_version")
+    if corpus_version.stale:
+        # La respuesta sale del corpus anterior (el proceso aún no lo ha recargado): no se guarda.
+        return {}
+    # El embedding de la pregunta ya está en la caché de embeddings: no hay llamada extra a Ollama.
+    ollama_embeddings = await resources.aget("ollama_embeddings")
+    question_vector = await ollama_embeddings.aembed_query(question)
+    (await resources.aget("answer_cache")).store(question_vector, state["datasource"], corpus_version.loaded_hash,
+                                        state["messages"][-1].content)
+    return {}
+
+async def answer_cached(state: RagGraphState) -> Union[Literal["hit"], List[str]]:
+    """Con acierto en caché termina; si no, lanza en paralelo las dos ramas de búsqueda."""
+    return "hit" if state.get("cache_hit") else ["dense", "sparse"]
+
+# COMENTARIO: La recuperación se divide en dos ramas que LangGraph ejecuta en paralelo
+# (búsqueda densa en Qdrant y búsqueda BM25), y un nodo que une sus resultados.
+async def retrieve_dense(state: RagGraphState) -> RagGraphState:
+    """Rama densa: embedding de la pregunta y búsqueda en Qdrant, con clientes asíncronos."""
+    print(f"---(Nodo: Búsqueda Densa en '{state['datasource']}')---")
+    question = state["question"]
     datasource = state["datasource"]
-    
-    # COMENTARIO: Aumentamos el límite para obtener más candidatos para el reranker
-    CANDIDATE_LIMIT = 20
 
     qdrant_filter = None
     if datasource != "both":
-        source_map = {"legacy": "PGC_1990", "actual": "PGC_actual"}
-        qdrant_filter = models.Filter(must=[models.FieldCondition(key="source", match=models.MatchValue(value=source_map[datasource]))])
+        qdrant_filter = models.Filter(must=[models.FieldCondition(key="source", match=models.MatchValue(value=SOURCE_MAP[datasource]))])
 
-    query_vector = ollama_embeddings.embed_query(question)
-    qdrant_results = qdrant_client.search(
+    ollama_embeddings = await resources.aget("ollama_embeddings")
+    async_qdrant_client = await resources.aget("async_qdrant_client")
+    query_vector = await ollama_embeddings.aembed_query(question)
+    qdrant_results = await async_qdrant_client.search(
         collection_name=QDRANT_COLLECTION_NAME,
         query_vector=query_vector,
         limit=CANDIDATE_LIMIT,
-        query_filter=qdrant_filter
+        query_filter=qdrant_filter,
+        with_payload=False
     )
-    
-    tokenized_query = question.lower().split(" ")
-    bm25_scores = bm25_index.get_scores(tokenized_query)
-    all_bm25_candidates = [(bm25_scores[i], i) for i in range(len(bm25_scores))]
-
-    if datasource != "both":
-        filtered_candidates = [(score, idx) for score, idx in all_bm25_candidates if all_chunks_data[idx]['source'] == datasource]
-    else:
-        filtered_candidates = all_bm25_candidates
-
-    filtered_candidates.sort(key=lambda x: x[0], reverse=True)
-    top_bm25_indices = [idx for score, idx in filtered_candidates[:CANDIDATE_LIMIT]]
-    
-    final_docs = {}
+    # COMENTARIO: Los ids de Qdrant son UUID del contenido; se traducen al id del chunk en el almacén
+    chunk_store = await resources.aget("chunk_store")
+    dense_results = []
     for hit in qdrant_results:
-        doc_text = all_chunks_data[hit.id]['contextualized_chunk']
-        final_docs[doc_text] = hit.score
+        chunk_id = chunk_store.chunk_id(hit.id)
+        if chunk_id is not None:
+            dense_results.append((chunk_id, hit.score))
+    return {"dense_results": dense_results}
+
+async def retrieve_sparse(state: RagGraphState) -> RagGraphState:
+    """Rama dispersa: BM25 sobre la partición de la fuente elegida (no depende del embedding)."""
+    print(f"---(Nodo: Búsqueda BM25 en '{state['datasource']}')---")
+    question = state["question"]
+    datasource = state["datasource"]
 
-    for idx in top_bm25_indices:
-        doc_text = bm25_corpus[idx]
-        if doc_text not in final_docs:
-            final_docs[doc_text] = bm25_scores[idx]
+    # COMENTARIO: Solo se consulta la partición BM25 de la fuente elegida (o la unificada para 'both')
+    bm25_index = await resources.aget("bm25_index")
+    tokenized_query = analyzer.analyze(question)
+    bm25_source = None if datasource == "both" else SOURCE_MAP[datasource]
+    top_bm25_indices, top_bm25_scores = await run_cpu(bm25_index.get_top_n, tokenized_query, CANDIDATE_LIMIT, bm25_source)
+    return {"sparse_results": list(zip(top_bm25_indices.tolist(), top_bm25_scores.tolist()))}
 
-    # COMENTARIO: Ya no filtramos a los 5 mejores, pasamos la lista completa de candidatos.
-    unique_documents = list(final_docs.keys())
-    print(f"Documentos recuperados para reranking: {len(unique_documents)}")
-    return {"documents": unique_documents}
+async def retrieve_documents(state: RagGraphState) -> RagGraphState:
+    """Fusiona por id de chunk los resultados de las dos ramas de búsqueda en la lista ordenada de candidatos."""
+    print("---(Nodo: Uniendo Documentos Recuperados)---")
+    # COMENTARIO: La fusión y la deduplicación trabajan con ids enteros; el texto solo se lee del
+    # almacén de chunks cuando lo necesitan el reranker y el generador.
+    if FUSION_METHOD == "minmax":
+        fused = normalized_score_fusion([state["dense_results"], state["sparse_results"]],
+                                        [FUSION_DENSE_WEIGHT, 1.0 - FUSION_DENSE_WEIGHT])
+    else:
+        fused = reciprocal_rank_fusion(
+            [[chunk_id for chunk_id, _ in state["dense_results"]], [chunk_id for chunk_id, _ in state["sparse_results"]]],
+            k=RRF_K,
+        )
+    print(f"Documentos recuperados para reranking: {len(fused)}")
+    return {
+        "document_ids": [chunk_id for chunk_id, _ in fused],
+        "document_scores": [score for _, score in fused],
+    }
 
 # COMENTARIO: Reintroducimos el nodo rerank_documents
-def rerank_documents(state: RagGraphState) -> RagGraphState:
-    """Nodo de Reclasificación: filtra y ordena los documentos por relevancia."""
+async def rerank_documents(state: RagGraphState) -> RagGraphState:
+    """Nodo de Reclasificación: ordena los candidatos por relevancia y ajusta el contexto al presupuesto de tokens."""
     print("---(Nodo: Reclasificando Documentos)---")
-    # Lee la pregunta del último mensaje
-    question = state["messages"][-1].content
-    documents = state["documents"]
+    question = state["question"]
+    document_ids = state["document_ids"]
     
-    if not documents:
-        return {"documents": []}
+    if not document_ids:
+        return {"document_ids": [], "document_scores": []}
 
-    pairs = [(question, doc) for doc in documents]
-    scores = reranker.predict(pairs)
-    reranked_docs = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True)
-    
-    TOP_K = 5
-    final_documents = [doc for doc, score in reranked_docs[:TOP_K]]
+    chunk_store = await resources.aget("chunk_store")
+    scores = state["document_scores"]
+    # COMENTARIO: Si la fusión ya separa claramente a los primeros candidatos no se usa el cross-encoder;
+    # si el salto aparece más abajo, solo se reranquean los candidatos que quedan por encima.
+    rerank_count = rerank_cutoff(scores, keep=RERANK_SKIP_TOP,
+                                 max_candidates=RERANK_MAX_CANDIDATES, min_margin=RERANK_SKIP_MARGIN)
+    if rerank_count:
+        # COMENTARIO: Los scores ya calculados para (pregunta, chunk) se sirven desde la caché
+        reranker = await resources.aget("reranker")
+        rerank_cache = await resources.aget("rerank_cache")
+        rerank_scores = await rerank_cache.ascore(reranker, question, document_ids[:rerank_count], chunk_store.text)
+        reranked_docs = sorted(zip(document_ids[:rerank_count], rerank_scores.tolist()), key=lambda x: x[1], reverse=True)
+        # COMENTARIO: El resto de candidatos sigue detrás, en el orden de la fusión, para que el presupuesto de
+        # tokens pueda completar el contexto con ellos (sus scores son los de la fusión, no los del reranker).
+        document_ids = [chunk_id for chunk_id, score in reranked_docs] + document_ids[rerank_count:]
+        scores = [score for chunk_id, score in reranked_docs] + scores[rerank_count:]
+        print(f"Candidatos reclasificados: {rerank_count}")
+    else:
+        print("Reranking omitido: la fusión de ambas búsquedas tiene un margen claro.")
+
+    # COMENTARIO: El número de documentos lo decide el presupuesto de tokens del generador, no un TOP_K fijo
+    count_tokens = await resources.aget("generator_tokenizer")
+    documents = chunk_store.texts(document_ids[:CONTEXT_MAX_DOCUMENTS])
+    selected = await run_cpu(select_by_token_budget, documents, count_tokens, CONTEXT_TOKEN_BUDGET, CONTEXT_MAX_DOCUMENTS)
     
-    print(f"Documentos después de reranking: {len(final_documents)}")
-    return {"documents": final_documents}
+    print(f"Documentos después de reranking: {selected}")
+    return {"document_ids": document_ids[:selected], "document_scores": scores[:selected]}
 
 # Reemplaza tu función 'generate_answer' con esta
-def generate_answer(state: RagGraphState) -> RagGraphState:
+async def generate_answer(state: RagGraphState, config: RunnableConfig) -> RagGraphState:
     print("---(Nodo: Generando Respuesta)---")
-    question = state["messages"][-1].content
-    documents = state["documents"]
+    question = state["question"]
+    documents = (await resources.aget("chunk_store")).texts(state["document_ids"])
+    # COMENTARIO: El historial que llega al prompt está acotado: resumen + últimos turnos
+    history = format_history(state["messages"][:-1]) or "(sin mensajes previos)"
+    summary = state.get("summary") or "(ninguno)"
     
     context_str = "\n\n---\n\n".join(documents)
     prompt = f"""
-    Eres un asistente experto en contabilidad. Responde a la pregunta del usuario basándote estricta y únicamente en el siguiente contexto. Si la pregunta es una comparación, asegúrate de usar la información de ambas fuentes si se proporciona. Si la respuesta no está en el contexto, indícalo claramente.
+    Eres un asistente experto en contabilidad. Responde a la pregunta del usuario basándote estricta y únicamente en el siguiente contexto. Si la pregunta es una comparación, asegúrate de usar la información de ambas fuentes si se proporciona. Si la respuesta no está en el contexto, indícalo claramente. Usa la conversación previa solo para entender a qué se refiere la pregunta.
+
+    RESUMEN DE LA CONVERSACIÓN:
+    {summary}
+
+    ÚLTIMOS MENSAJES:
+    {history}
 
     CONTEXTO:
     {context_str}
@@ -120,15 +254,20 @@ def generate_answer(state: RagGraphState) -> RagGraphState:
 
     RESPUESTA:
     """
-    response = llm_generator.invoke(prompt)
+    # COMENTARIO: Con astream (y la config del nodo) LangGraph reenvía cada token al modo de
+    # streaming "messages", que es lo que consume el endpoint /chat/stream.
+    llm_generator = await resources.aget("llm_generator")
+    answer = ""
+    async for chunk in llm_generator.astream(prompt, config=config):
+        answer += chunk.content
     
     # Antes: return {"generation": response.content}
     # Ahora:
-    return {"messages": [AIMessage(content=response.content)]}
+    return {"messages": [AIMessage(content=answer)]}
 
 
 # COMENTARIO: Nuevo nodo para el caso de no encontrar documentos
-def handle_no_documents(state: RagGraphState) -> RagGraphState:
+async def handle_no_documents(state: RagGraphState) -> RagGraphState:
     response_text = "Lo siento, no he podido encontrar información relevante para responder a tu pregunta."
     
     # Antes: return {"generation": response_text}
@@ -136,6 +275,6 @@ def handle_no_documents(state: RagGraphState) -> RagGraphState:
     return {"messages": [AIMessage(content=response_text)]}
 
 # COMENTARIO: Nuevo borde condicional
-def documents_exist(state: RagGraphState) -> Literal["continue", "handle_no_docs"]:
-    return "continue" if state["documents"] else "handle_no_docs"
+async def documents_exist(state: RagGraphState) -> Literal["continue", "handle_no_docs"]:
+    return "continue" if state["document_ids"] else "handle_no_docs"
 
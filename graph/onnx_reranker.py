@@ -0,0 +1,86 @@
+# graph/onnx_reranker.py
+# Backend ONNX Runtime (int8 con cuantización dinámica) para el cross-encoder ms-marco.
+# Expone la misma interfaz predict(pairs, batch_size) que sentence_transformers.CrossEncoder,
+# así que RerankerService puede usar uno u otro indistintamente (RERANKER_BACKEND).
+# El modelo se exporta una sola vez con export_onnx_model (ver desarrollo/6_reranker_onnx.py).
+
+import os
+from typing import Sequence, Tuple
+
+import numpy as np
+
+_INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+class OnnxCrossEncoder:
+    """
+    Atributos:
+        tokenizer: El tokenizer de Hugging Face del modelo original (el mismo que usa CrossEncoder).
+        session: Sesión de ONNX Runtime en CPU.
+        max_length: Longitud máxima (en tokens) de cada par pregunta-documento.
+    """
+
+    def __init__(self, model_path: str, tokenizer_name: str, max_length: int = 512, intra_op_threads: int = 0):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        self.max_length = max_length
+
+    def predict(self, pairs: Sequence[Tuple[str, str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """Devuelve los logits de relevancia de cada par (igual que CrossEncoder con activación identidad)."""
+        scores = []
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            encoded = self.tokenizer(
+                [question for question, _ in batch],
+                [document for _, document in batch],
+                padding=True,
+                truncation="longest_first",
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            feed = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+            logits = self.session.run(None, feed)[0]
+            scores.append(logits[:, 0] if logits.ndim == 2 else logits)
+        return np.concatenate(scores) if scores else np.empty(0, dtype=np.float32)
+
+
+def export_onnx_model(model_name: str, output_path: str, quantize: bool = True, opset_version: int = 17) -> str:
+    """
+    Exporta el modelo de Hugging Face a ONNX y, si quantize=True, aplica cuantización dinámica int8
+    a los pesos (QInt8). Devuelve la ruta del modelo final.
+    """
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+    dummy = tokenizer(["pregunta de ejemplo"], ["documento de ejemplo"], return_tensors="pt")
+    input_names = [name for name in _INPUT_NAMES if name in dummy]
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    fp32_path = output_path.replace(".onnx", "-fp32.onnx") if quantize else output_path
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(dummy[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QInt8)
+    return output_path
@@ -0,0 +1,122 @@
+# graph/reranker_service.py
+# Servicio de reranking con micro-batching dinámico.
+# Las peticiones concurrentes encolan sus pares (pregunta, documento); un único hilo de inferencia
+# las agrupa en lotes más grandes (hasta max_batch_size pares o max_wait_ms de espera) y resuelve
+# un Future por petición. Así las peticiones no compiten por la CPU con pasadas pequeñas separadas
+# y el event loop nunca queda bloqueado por el CrossEncoder.
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+Pair = Tuple[str, str]
+
+
+class RerankerService:
+    """
+    Atributos:
+        model: Objeto con predict(pairs, batch_size=...) (p. ej. un CrossEncoder).
+        max_batch_size: Máximo de pares por pasada del modelo.
+        max_wait_ms: Tiempo máximo que se espera a otras peticiones para completar un lote.
+        backend: 'torch' u 'onnx'; con 'torch' el hilo del worker fija torch_threads.
+    """
+
+    def __init__(self, model, max_batch_size: int = 64, max_wait_ms: float = 5.0,
+                 backend: str = "torch", torch_threads: Optional[int] = None):
+        self.model = model
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.torch_threads = torch_threads
+        self._queue: "queue.Queue[Tuple[List[Pair], Future]]" = queue.Queue()
+        self._batches = 0
+        self._pairs = 0
+        self._requests = 0
+        self._worker = threading.Thread(target=self._run, name="reranker-worker", daemon=True)
+        self._worker.start()
+
+    def _collect_batch(self) -> List[Tuple[List[Pair], Future]]:
+        """Espera una petición y añade las que lleguen hasta llenar el lote o agotar max_wait_ms."""
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        if self.backend == "torch" and self.torch_threads:
+            # Con el backend ONNX los hilos se configuran en la propia sesión de ONNX Runtime.
+            import torch
+            torch.set_num_threads(self.torch_threads)
+        while True:
+            # COMENTARIO: Las peticiones canceladas (cliente desconectado) se descartan sin puntuarlas;
+            # las demás pasan a 'running' y ya no se pueden cancelar mientras se calculan.
+            batch = [(pairs, future) for pairs, future in self._collect_batch()
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            all_pairs = [pair for pairs, _ in batch for pair in pairs]
+            try:
+                scores = np.asarray(self.model.predict(all_pairs, batch_size=self.max_batch_size))
+            except Exception as e:
+                for _, future in batch:
+                    self._deliver(future, exception=e)
+                continue
+            self._batches += 1
+            self._pairs += len(all_pairs)
+            self._requests += len(batch)
+            start = 0
+            for pairs, future in batch:
+                self._deliver(future, result=scores[start:start + len(pairs)])
+                start += len(pairs)
+
+    @staticmethod
+    def _deliver(future: Future, result=None, exception: Optional[BaseException] = None):
+        """Resuelve un Future sin que un fallo al entregar un resultado pueda detener el hilo de inferencia."""
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except Exception as e:
+            print(f"No se pudo entregar un resultado del reranker: {type(e).__name__}: {e}")
+
+    def submit(self, pairs: Sequence[Pair]) -> Future:
+        """Encola los pares y devuelve un Future con sus scores (en el mismo orden)."""
+        future: Future = Future()
+        if not pairs:
+            future.set_result(np.empty(0, dtype=np.float32))
+            return future
+        self._queue.put((list(pairs), future))
+        return future
+
+    def predict(self, pairs: Sequence[Pair]) -> np.ndarray:
+        """Misma interfaz que CrossEncoder.predict (bloqueante)."""
+        return self.submit(pairs).result()
+
+    async def apredict(self, pairs: Sequence[Pair]) -> np.ndarray:
+        """Versión asíncrona: el nodo del grafo espera sin bloquear el event loop."""
+        return await asyncio.wrap_future(self.submit(pairs))
+
+    def stats(self) -> dict:
+        return {
+            "batches": self._batches,
+            "requests": self._requests,
+            "pairs": self._pairs,
+            "avg_pairs_per_batch": round(self._pairs / self._batches, 2) if self._batches else 0.0,
+            "queue_depth": self._queue.qsize(),
+        }
@@ -0,0 +1,127 @@
+# graph/resources.py
+# Gestor de recursos con carga perezosa y en paralelo.
+# Cada recurso (índices, clientes, modelos) se carga en su propio hilo en segundo plano;
+# los nodos del grafo solo esperan por el recurso concreto que necesitan.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+PENDING = "pending"
+LOADING = "loading"
+READY = "ready"
+ERROR = "error"
+
+
+class ResourceHandle:
+    """Referencia a un recurso que se está cargando (o ya cargado) en segundo plano."""
+
+    def __init__(self, name: str, loader: Callable[[], Any]):
+        self.name = name
+        self.loader = loader
+        self.future: Future = Future()
+        self.state = PENDING
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def _run(self):
+        # COMENTARIO: Con el futuro en estado 'running', Future.cancel() ya no tiene efecto: la cancelación
+        # de una petición que espera el recurso nunca puede invalidar la carga compartida.
+        if not self.future.set_running_or_notify_cancel():
+            self.future = Future()
+            self.future.set_running_or_notify_cancel()
+        self.state = LOADING
+        self.started_at = time.time()
+        try:
+            value = self.loader()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self.finished_at = time.time()
+            self.future.set_exception(e)
+            self.state = ERROR
+            print(f"Error al cargar el recurso '{self.name}': {self.error}")
+            return
+        self.finished_at = time.time()
+        self.future.set_result(value)
+        self.state = READY
+        print(f"Recurso '{self.name}' cargado en {self.finished_at - self.started_at:.2f}s.")
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """Devuelve el recurso, bloqueando hasta que esté cargado."""
+        return self.future.result(timeout)
+
+    async def aget(self) -> Any:
+        """
+        Versión asíncrona de get(): espera sin bloquear el event loop. shield() evita que cancelar
+        a quien espera (p. ej. un cliente que se desconecta) cancele el futuro compartido.
+        """
+        return await asyncio.shield(asyncio.wrap_future(self.future))
+
+    def __await__(self):
+        return self.aget().__await__()
+
+    def replace(self, value: Any):
+        """Sustituye el valor de un recurso cargado (recarga en caliente). Quien ya lo obtuvo sigue con el anterior."""
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+        future.set_result(value)
+        self.future = future
+        self.error = None
+        self.finished_at = time.time()
+        self.state = READY
+
+    def status(self) -> Dict[str, Any]:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = round((self.finished_at or time.time()) - self.started_at, 3)
+        return {"state": self.state, "seconds": elapsed, "error": self.error}
+
+
+class ResourceManager:
+    """Registra los recursos de la aplicación y los carga concurrentemente en hilos."""
+
+    def __init__(self):
+        self._handles: Dict[str, ResourceHandle] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[[], Any]) -> ResourceHandle:
+        handle = ResourceHandle(name, loader)
+        self._handles[name] = handle
+        return handle
+
+    def start(self):
+        """Lanza la carga de todos los recursos registrados (no bloquea)."""
+        with self._lock:
+            if self._executor is not None:
+                return
+            # Un hilo por recurso: así un loader puede esperar a otro recurso sin riesgo de bloqueo.
+            self._executor = ThreadPoolExecutor(max_workers=max(len(self._handles), 1),
+                                                thread_name_prefix="resource-loader")
+            for handle in self._handles.values():
+                self._executor.submit(handle._run)
+
+    def __getitem__(self, name: str) -> ResourceHandle:
+        return self._handles[name]
+
+    def get(self, name: str, timeout: Optional[float] = None) -> Any:
+        """Atajo para resources[name].get()."""
+        return self._handles[name].get(timeout)
+
+    async def aget(self, name: str) -> Any:
+        """Atajo para await resources[name].aget()."""
+        return await self._handles[name].aget()
+
+    def replace(self, values: Dict[str, Any]):
+        """Sustituye varios recursos a la vez (sin ceder el control entre uno y otro si se llama desde el event loop)."""
+        for name, value in values.items():
+            self._handles[name].replace(value)
+
+    def is_ready(self) -> bool:
+        return all(handle.state == READY for handle in self._handles.values())
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        return {name: handle.status() for name, handle in self._handles.items()}
@@ -0,0 +1,182 @@
+# graph/router.py
+# Router de fuente de datos ('legacy', 'actual', 'both') en tres niveles:
+#   1. Reglas (expresiones regulares) para los casos evidentes: "1990", "comparar", "evolución"...
+#   2. Clasificador local por centroides de embeddings entrenado con ejemplos etiquetados.
+#   3. El LLM de routing, solo cuando los niveles anteriores no tienen suficiente confianza.
+# Cada decisión indica qué nivel la tomó, para medir cuánto tráfico deja de ir al LLM.
+
+import json
+import re
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from graph.admission import OverloadedError
+from graph.analyzer import fold_text
+
+DATASOURCES = ("legacy", "actual", "both")
+DEFAULT_DATASOURCE = "actual"
+
+ROUTING_PROMPT = """
+    Tu tarea es clasificar la pregunta de un usuario sobre contabilidad para determinar qué base de conocimiento consultar.
+    Las opciones son:
+    - 'legacy': para preguntas sobre el Plan General Contable de 1990.
+    - 'actual': para preguntas sobre el Plan General Contable vigente (post-2007).
+    - 'both': para preguntas que comparan ambos planes o preguntan sobre su evolución.
+
+    Pregunta del usuario: "{question}"
+
+    Analiza la pregunta y responde únicamente con un objeto JSON con la clave "datasource" y uno de los tres valores: "legacy", "actual", o "both".
+    """
+
+# Ejemplos etiquetados por defecto para entrenar el clasificador de centroides.
+# Se pueden sustituir con un JSON {"legacy": [...], "actual": [...], "both": [...]} (ROUTER_EXAMPLES_FILE).
+DEFAULT_EXAMPLES = {
+    "legacy": [
+        "¿Qué cuentas tenía el grupo 1 en el plan de 1990?",
+        "Según el PGC de 1990, ¿cómo se contabilizaban los gastos de establecimiento?",
+        "¿Cómo se valoraban las existencias en el antiguo plan contable?",
+        "En el plan general contable anterior, ¿qué era la cuenta 200?",
+        "¿Cuál era el tratamiento de las provisiones en el PGC del 90?",
+        "Definición de inmovilizado inmaterial en el plan antiguo",
+    ],
+    "actual": [
+        "¿Cuáles son las cuentas del grupo 1?",
+        "¿Cómo se registra la amortización del inmovilizado intangible?",
+        "¿Qué es el patrimonio neto según el PGC vigente?",
+        "¿Cómo se contabiliza un arrendamiento financiero?",
+        "¿Qué recoge la cuenta 430 Clientes?",
+        "Normas de registro y valoración de los instrumentos financieros",
+        "¿Qué información debe incluir la memoria de las cuentas anuales?",
+    ],
+    "both": [
+        "¿Qué diferencias hay entre el plan de 1990 y el actual en el grupo 2?",
+        "Compara el tratamiento de las existencias en ambos planes",
+        "¿Cómo ha evolucionado la contabilización de los gastos de establecimiento?",
+        "¿Qué cambió en las provisiones con el nuevo plan de 2007?",
+        "Diferencias entre el PGC de 1990 y el de 2007",
+        "¿Qué cuentas desaparecieron respecto al plan anterior?",
+    ],
+}
+
+
+class RouteDecision(NamedTuple):
+    datasource: str
+    decided_by: str  # 'rules', 'classifier', 'llm' o 'default'
+    confidence: float
+
+
+class RuleRouter:
+    """Nivel 1: reglas con expresiones regulares precompiladas."""
+
+    # Los patrones evitan expresiones contables ambiguas como "valor actual" o "ejercicios anteriores".
+    # "2007" y "nuevo plan" no son reglas de "actual": aparecen casi siempre en preguntas de comparación
+    # ("¿qué cambió con el nuevo plan de 2007?"), que se dejan al clasificador.
+    RULES = {
+        "both": re.compile(r"\b(compar\w*|evoluci\w*|ambos (planes|pgc)|diferencias? entre (el |los )?(plan|pgc)"
+                           r"|frente al? (plan|pgc)|respecto al? (plan|pgc) (anterior|antiguo|de 1990)"
+                           r"|vs|versus|antes y despues)\b"),
+        "legacy": re.compile(r"\b(1990|(plan|pgc)( contable)? (antiguo|anterior|derogado|del 90)|rd 1643)\b"),
+        "actual": re.compile(r"\b(vigente|(plan|pgc)( contable)? actual|rd 1514)\b"),
+    }
+
+    def route(self, question: str) -> Optional[RouteDecision]:
+        text = fold_text(question)
+        matched = {label for label, pattern in self.RULES.items() if pattern.search(text)}
+        if "both" in matched or {"legacy", "actual"} <= matched:
+            return RouteDecision("both", "rules", 1.0)
+        if len(matched) == 1:
+            return RouteDecision(matched.pop(), "rules", 1.0)
+        return None
+
+
+class CentroidRouter:
+    """Nivel 2: similitud coseno con el centroide de los embeddings de los ejemplos de cada etiqueta."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.labels: List[str] = []
+        self.centroids: Optional[np.ndarray] = None
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def fit(self, examples: Dict[str, List[str]]) -> "CentroidRouter":
+        labels, centroids = [], []
+        for label, texts in examples.items():
+            vectors = self._normalize(np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32))
+            labels.append(label)
+            centroids.append(vectors.mean(axis=0))
+        self.labels = labels
+        self.centroids = self._normalize(np.stack(centroids))
+        return self
+
+    def predict(self, question_vector: List[float]) -> RouteDecision:
+        """La confianza es el margen entre la etiqueta más similar y la segunda."""
+        similarities = self.centroids @ self._normalize(np.asarray(question_vector, dtype=np.float32))
+        order = np.argsort(-similarities)
+        margin = float(similarities[order[0]] - similarities[order[1]]) if len(order) > 1 else 1.0
+        return RouteDecision(self.labels[order[0]], "classifier", margin)
+
+
+class HybridRouter:
+    """
+    Encadena reglas, clasificador y LLM. Con mode='local' nunca se llama al LLM
+    (si la confianza es baja se usa la predicción del clasificador igualmente).
+    """
+
+    def __init__(self, llm=None, embeddings=None, classifier: Optional[CentroidRouter] = None,
+                 min_confidence: float = 0.05, mode: str = "hybrid"):
+        self.rules = RuleRouter()
+        self.classifier = classifier
+        self.embeddings = embeddings
+        self.llm = llm
+        self.min_confidence = min_confidence
+        self.mode = mode
+        self._counts = {"rules": 0, "classifier": 0, "llm": 0, "default": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, decision: RouteDecision) -> RouteDecision:
+        with self._lock:
+            self._counts[decision.decided_by] += 1
+        return decision
+
+    @staticmethod
+    def _parse_llm_output(content: str) -> str:
+        datasource = json.loads(content).get("datasource", DEFAULT_DATASOURCE)
+        return datasource if datasource in DATASOURCES else DEFAULT_DATASOURCE
+
+    async def aroute(self, question: str) -> RouteDecision:
+        guess = None
+        if self.mode != "llm":
+            decision = self.rules.route(question)
+            if decision is not None:
+                return self._count(decision)
+
+            if self.classifier is not None:
+                # El embedding sale de la caché de embeddings y se reutiliza en la búsqueda densa.
+                guess = self.classifier.predict(await self.embeddings.aembed_query(question))
+                if guess.confidence >= self.min_confidence or self.mode == "local":
+                    return self._count(guess)
+            elif self.mode == "local":
+                return self._count(RouteDecision(DEFAULT_DATASOURCE, "default", 0.0))
+
+        try:
+            response = await self.llm.ainvoke(ROUTING_PROMPT.format(question=question))
+            return self._count(RouteDecision(self._parse_llm_output(response.content), "llm", 1.0))
+        except (json.JSONDecodeError, AttributeError, OverloadedError):
+            # Si el LLM no devuelve un JSON válido (o está saturado) se usa la predicción del clasificador, si la hay.
+            return self._count(guess or RouteDecision(DEFAULT_DATASOURCE, "default", 0.0))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = dict(self._counts)
+        total = sum(counts.values())
+        return {
+            "mode": self.mode,
+            "decisions": counts,
+            "llm_ratio": round(counts["llm"] / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,56 @@
+# graph/score_cache.py
+# Caché de scores del cross-encoder indexada por (hash de la pregunta normalizada, id de chunk).
+# La clave no incluye el texto del chunk: ocupa unas decenas de bytes por entrada aunque el
+# documento tenga cientos de caracteres. Solo los pares que no están en caché llegan al modelo.
+
+import hashlib
+import sys
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+from graph.cache import LRUCache
+from graph.embedding_cache import normalize_question
+
+
+def question_key(question: str) -> bytes:
+    """Hash compacto (8 bytes) de la pregunta normalizada."""
+    return hashlib.blake2b(normalize_question(question).encode("utf-8"), digest_size=8).digest()
+
+
+# Tamaño aproximado de una entrada: clave (tupla de bytes + int), valor (float) y nodo del OrderedDict.
+_ENTRY_BYTES = (sys.getsizeof((b"", 0)) + sys.getsizeof(b"\0" * 8) + sys.getsizeof(2 ** 20)
+                + sys.getsizeof((0.0, None)) + sys.getsizeof(0.0) + 100)
+
+
+class RerankScoreCache:
+    def __init__(self, maxsize: int = 20000):
+        self.scores = LRUCache(maxsize=maxsize)
+
+    async def ascore(self, reranker, question: str, chunk_ids: Sequence[int],
+                     text_of: Callable[[int], str]) -> np.ndarray:
+        """
+        Scores de cada chunk para la pregunta; solo los fallos de caché se envían al reranker.
+        'text_of' devuelve el texto de un id de chunk y solo se llama para los fallos.
+        """
+        key = question_key(question)
+        scores = np.empty(len(chunk_ids), dtype=np.float32)
+        missing: List[int] = []
+        for position, chunk_id in enumerate(chunk_ids):
+            cached = self.scores.get((key, chunk_id))
+            if cached is None:
+                missing.append(position)
+            else:
+                scores[position] = cached
+
+        if missing:
+            new_scores = await reranker.apredict([(question, text_of(chunk_ids[position])) for position in missing])
+            for position, score in zip(missing, new_scores.tolist()):
+                scores[position] = score
+                self.scores.set((key, chunk_ids[position]), score)
+        return scores
+
+    def stats(self) -> Dict:
+        stats = self.scores.stats()
+        stats["approx_memory_bytes"] = len(self.scores) * _ENTRY_BYTES
+        return stats
@@ -0,0 +1,91 @@
+# graph/selection.py
+# Política adaptativa de selección de candidatos entre la recuperación y el generador:
+#   1. Fusión por id de chunk de las listas densa y BM25: Reciprocal Rank Fusion (solo usa posiciones,
+#      así que no hay que calibrar entre sí los scores coseno y BM25) o suma ponderada de scores
+#      normalizados min-max por lista.
+#   2. Corte del reranking: si los primeros candidatos fusionados quedan claramente separados del
+#      resto (ambas búsquedas coinciden), se omite el cross-encoder; si el salto aparece más abajo,
+#      solo se reranquean los candidatos hasta ese salto.
+#   3. Contexto dimensionado por un presupuesto de tokens del tokenizer del generador, en lugar de
+#      un número fijo de documentos.
+
+from typing import Callable, Dict, List, Sequence, Tuple
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """Fusiona listas de ids ordenadas: score(d) = suma de 1 / (k + posición). Devuelve (id, score) ordenados."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def normalized_score_fusion(results: Sequence[Sequence[Tuple[int, float]]],
+                            weights: Sequence[float]) -> List[Tuple[int, float]]:
+    """
+    Alternativa a RRF: normaliza cada lista (id, score) a [0, 1] con min-max y suma los scores
+    ponderados. Un id ausente de una lista no suma nada por ella.
+    """
+    fused: Dict[int, float] = {}
+    for hits, weight in zip(results, weights):
+        if not hits:
+            continue
+        scores = [score for _, score in hits]
+        low, high = min(scores), max(scores)
+        span = high - low
+        for doc_id, score in hits:
+            normalized = (score - low) / span if span > 0 else 1.0
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * normalized
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def rerank_cutoff(scores: Sequence[float], keep: int, max_candidates: int, min_margin: float) -> int:
+    """
+    Número de candidatos (en orden de fusión) que hay que pasar por el reranker.
+    Devuelve 0 si los 'keep' primeros ya están separados del siguiente por un salto relativo de al
+    menos 'min_margin'; si el primer salto claro aparece después, se corta ahí; si no, max_candidates.
+    """
+    limit = min(len(scores), max_candidates)
+    if len(scores) <= keep:
+        return 0
+    for position in range(keep, limit):
+        previous = scores[position - 1]
+        if previous > 0 and (previous - scores[position]) / previous >= min_margin:
+            return 0 if position == keep else position
+    return limit
+
+
+def select_by_token_budget(documents: Sequence[str], count_tokens: Callable[[str], int],
+                           budget: int, max_documents: int) -> int:
+    """Cuántos documentos (en orden) caben en 'budget' tokens; siempre al menos uno si hay documentos."""
+    used = 0
+    for position, document in enumerate(documents[:max_documents]):
+        used += count_tokens(document)
+        if used > budget:
+            return max(position, 1)
+    return min(len(documents), max_documents)
+
+
+class TokenCounter:
+    """
+    Cuenta tokens con el tokenizer de Hugging Face del generador. Si no se puede cargar
+    (sin conexión, modelo desconocido), usa la aproximación de ~4 caracteres por token.
+    """
+
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, tokenizer_name: str):
+        self.tokenizer_name = tokenizer_name
+        self.tokenizer = None
+        if tokenizer_name:
+            try:
+                from transformers import AutoTokenizer
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+            except Exception as e:
+                print(f"No se pudo cargar el tokenizer '{tokenizer_name}', se estimarán los tokens: {e}")
+
+    def __call__(self, text: str) -> int:
+        if self.tokenizer is None:
+            return len(text) // self.CHARS_PER_TOKEN + 1
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
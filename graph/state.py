@@ -1,5 +1,5 @@
 # --- 2. Definir el Estado del Grafo ---
-from typing import List, TypedDict, Literal, Sequence, Annotated
+from typing import List, Tuple, TypedDict, Literal, Sequence, Annotated
 from langchain_core.messages import BaseMessage
 from langgraph.graph.message import add_messages
 
@@ -11,12 +11,27 @@ class RagGraphState(TypedDict):
     Atributos:
         messages: La lista de mensajes que forman la conversación. La anotación
                   hace que los nuevos mensajes se añadan en lugar de reemplazar.
-        documents: La lista de documentos recuperados para usar como contexto.
+        question: La pregunta del turno actual, reescrita como pregunta autónoma si era de seguimiento.
+        summary: Resumen acumulado de los turnos que ya no se conservan literalmente en 'messages'.
+        dense_results: Pares (id de chunk, score) de la búsqueda densa en Qdrant.
+        sparse_results: Pares (id de chunk, score) de la búsqueda BM25.
+        document_ids: Ids de chunk de los candidatos y, tras el reranking, de los documentos de contexto.
+                      El texto se lee del almacén de chunks solo cuando hace falta.
+        document_scores: Score de cada id de 'document_ids' (del reranker para los reclasificados, de fusión para el resto).
         datasource: La fuente de datos decidida por el router.
+        route_decided_by: Qué nivel del router tomó la decisión ('rules', 'classifier', 'llm' o 'default').
+        cache_hit: Si la respuesta se ha servido desde la caché semántica de respuestas.
     """
     # La clave 'messages' gestionará todo el historial de la conversación.
     messages: Annotated[Sequence[BaseMessage], add_messages]
     
     # Las otras claves se mantienen para los pasos intermedios.
-    documents: List[str]
-    datasource: Literal["legacy", "actual", "both"]
\ No newline at end of file
+    question: str
+    summary: str
+    dense_results: List[Tuple[int, float]]
+    sparse_results: List[Tuple[int, float]]
+    document_ids: List[int]
+    document_scores: List[float]
+    datasource: Literal["legacy", "actual", "both"]
+    route_decided_by: str
+    cache_hit: bool
\ No newline at end of file
@@ -1,18 +1,24 @@
 # ingest.py
 
-import json
 import os
-import pickle
 import sys
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Iterable, Iterator
 from qdrant_client import QdrantClient, models
 from langchain_ollama import OllamaEmbeddings
-from rank_bm25 import BM25Okapi
+from graph.bm25 import BM25Builder, load_index, save_index
+from graph.chunk_io import iter_chunks
+from graph.chunk_store import ChunkStore, ChunkStoreWriter, chunk_point_id
+from graph.document_embedding_cache import CachedDocumentEmbeddings, MmapEmbeddingStore
 
 # --- CONFIGURACIÓN ---
 # Mejor práctica: hacemos los nombres de los archivos también configurables
+# Fichero de chunks en JSON Lines (un chunk por línea) o en el formato antiguo (array JSON)
 INPUT_JSON_FILE = os.getenv("INPUT_JSON_FILE", "all_chunks_unificado.json")
-BM25_INDEX_FILE = os.getenv("BM25_INDEX_FILE", "bm25_index_unificado.pkl")
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", "bm25_index")
+CHUNK_STORE_FILE = os.getenv("CHUNK_STORE_FILE", "chunk_store.bin")
 QDRANT_COLLECTION_NAME = "contabilidad_unificada"
 VECTOR_DIMENSION = 768
 
@@ -21,25 +27,17 @@ QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://10.1.0.176:11434")
 OLLAMA_EMBEDDING_MODEL = "nomic-embed-text:latest" 
 
+# Pipeline de indexación: varios lotes se embeben a la vez mientras se suben los anteriores
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+INGEST_EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "4"))  # Peticiones de embeddings concurrentes
+INGEST_MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "8"))  # Lotes en cola como máximo (acota la memoria)
+INGEST_BARRIER_TIMEOUT = int(os.getenv("INGEST_BARRIER_TIMEOUT", "600"))
+# Caché en disco de embeddings de documentos: un reindexado del mismo contenido no llama a Ollama
+INGEST_EMBEDDING_CACHE_DIR = os.getenv("INGEST_EMBEDDING_CACHE_DIR", "embedding_cache")  # Vacío = sin caché
+INGEST_EMBEDDING_CACHE_DTYPE = os.getenv("INGEST_EMBEDDING_CACHE_DTYPE", "float32")  # 'float32' o 'float16'
 
 
 
-def check_if_data_exists(client: QdrantClient) -> bool:
-    """Comprueba si la colección ya existe y tiene datos."""
-    try:
-        # Intenta obtener información de la colección
-        collection_info = client.get_collection(collection_name=QDRANT_COLLECTION_NAME)
-        # Comprueba si hay vectores en la colección
-        if collection_info.vectors_count > 0:
-            print(f"La colección '{QDRANT_COLLECTION_NAME}' ya existe y contiene {collection_info.vectors_count} vectores.")
-            return True
-        else:
-            print(f"La colección '{QDRANT_COLLECTION_NAME}' existe pero está vacía.")
-            return False
-    except Exception:
-        # La excepción se lanza si la colección no existe
-        print(f"La colección '{QDRANT_COLLECTION_NAME}' no existe.")
-        return False
 
 def wait_for_qdrant(client: QdrantClient, timeout: int = 60):
     """Espera a que Qdrant esté disponible antes de continuar."""
@@ -56,21 +54,32 @@ def wait_for_qdrant(client: QdrantClient, timeout: int = 60):
     print("Error: No se pudo conectar a Qdrant después de 60 segundos.")
     return False
 
-def load_chunks_from_json(filename: str) -> list:
-    """Carga los chunks desde el archivo JSON."""
-    print(f"Cargando chunks desde '{filename}'...")
-    with open(filename, 'r', encoding='utf-8') as f:
-        return json.load(f)
+def feed_local_indexes(chunks: Iterable[dict], store_writer: ChunkStoreWriter,
+                       bm25_builder: BM25Builder) -> Iterator[dict]:
+    """
+    Deja pasar los chunks del fichero añadiendo cada uno al almacén y al índice BM25 en construcción.
+    Así una sola pasada por el fichero alimenta los índices locales y los embeddings.
+    """
+    for chunk in chunks:
+        store_writer.add(chunk)
+        # COMENTARIO: Se tokeniza con el mismo analizador que usa retrieve_documents para las consultas
+        bm25_builder.add(chunk['contextualized_chunk'], chunk['source'])
+        yield chunk
 
-def create_bm25_index(chunks: list):
-    """Crea y guarda un índice BM25."""
+def create_bm25_index(bm25_builder: BM25Builder, corpus_hash: str):
+    """Crea y guarda un índice BM25 disperso unificado más un índice por cada 'source'."""
     print("\nCreando índice BM25...")
-    corpus = [chunk['contextualized_chunk'] for chunk in chunks]
-    tokenized_corpus = [doc.split(" ") for doc in corpus]
-    bm25 = BM25Okapi(tokenized_corpus)
-    with open(BM25_INDEX_FILE, "wb") as f:
-        pickle.dump(bm25, f)
-    print(f"Índice BM25 guardado en '{BM25_INDEX_FILE}'.")
+    bm25 = bm25_builder.build()
+    for name, partition in bm25.partitions.items():
+        print(f"  - Partición '{name}': {partition.corpus_size} chunks, {len(partition.vocab)} términos.")
+    save_index(bm25, BM25_INDEX_DIR, corpus_hash=corpus_hash)
+    print(f"Índice BM25 guardado en '{BM25_INDEX_DIR}'.")
+
+def create_chunk_store(store_writer: ChunkStoreWriter):
+    """Guarda los chunks en el almacén binario que el backend abre con mmap."""
+    print("\nCreando almacén binario de chunks...")
+    store_writer.save(CHUNK_STORE_FILE)
+    print(f"Almacén de chunks guardado en '{CHUNK_STORE_FILE}'.")
 
 # def index_in_qdrant(client: QdrantClient, chunks: list, embeddings_model: OllamaEmbeddings):
 #     """Genera embeddings y los indexa en Qdrant en lotes."""
@@ -110,45 +119,177 @@ def create_bm25_index(chunks: list):
 #     print("\n¡Indexación en Qdrant completada con éxito!")
 
 
-def index_in_qdrant(client: QdrantClient, chunks: list, embeddings_model: OllamaEmbeddings):
-    """Genera embeddings y los indexa en Qdrant en lotes."""
-    print("\nIniciando indexación en Qdrant...")
-    client.recreate_collection(
-        collection_name=QDRANT_COLLECTION_NAME,
-        vectors_config=models.VectorParams(size=VECTOR_DIMENSION, distance=models.Distance.COSINE),
-    )
-    print(f"Colección '{QDRANT_COLLECTION_NAME}' creada/recreada.")
+def sync_chunk_store(store_writer: ChunkStoreWriter):
+    """Reescribe el almacén de chunks solo si el corpus ha cambiado."""
+    try:
+        if ChunkStore.open(CHUNK_STORE_FILE).corpus_hash == store_writer.corpus_hash:
+            print(f"\nEl almacén de chunks '{CHUNK_STORE_FILE}' está al día.")
+            return
+    except (OSError, ValueError):
+        pass
+    create_chunk_store(store_writer)
+
+def sync_bm25_index(bm25_builder: BM25Builder, corpus_hash: str):
+    """
+    Guarda el índice BM25 solo si el corpus ha cambiado. Cualquier cambio altera las estadísticas
+    globales (idf, longitud media), así que el índice se regenera entero; tarda segundos.
+    """
+    try:
+        load_index(BM25_INDEX_DIR, expected_corpus_hash=corpus_hash)
+        print(f"\nEl índice BM25 '{BM25_INDEX_DIR}' está al día.")
+        return
+    except (OSError, ValueError, KeyError):
+        pass
+    create_bm25_index(bm25_builder, corpus_hash)
+
+def ensure_collection(client: QdrantClient):
+    """Crea la colección si no existe (nunca la recrea: la ingesta es incremental)."""
+    if not client.collection_exists(collection_name=QDRANT_COLLECTION_NAME):
+        client.create_collection(
+            collection_name=QDRANT_COLLECTION_NAME,
+            vectors_config=models.VectorParams(size=VECTOR_DIMENSION, distance=models.Distance.COSINE),
+        )
+        print(f"Colección '{QDRANT_COLLECTION_NAME}' creada.")
 
-    batch_size = 64
-    total_chunks = len(chunks)
-    for i in range(0, total_chunks, batch_size):
-        batch_chunks = chunks[i:i+batch_size]
+def fetch_point_ids(client: QdrantClient) -> dict:
+    """
+    Ids de todos los puntos que ya hay en la colección (sin payload ni vectores), como
+    texto normalizado -> id tal como lo devuelve Qdrant. Solo se compara por el texto; para borrar se
+    usa el id original, porque Qdrant solo acepta enteros sin signo o UUID (una colección antigua
+    tiene ids enteros y "0" no es un id válido).
+    """
+    point_ids, offset = {}, None
+    while True:
+        records, offset = client.scroll(
+            collection_name=QDRANT_COLLECTION_NAME,
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        point_ids.update((str(record.id), record.id) for record in records)
+        if offset is None:
+            return point_ids
+
+def wait_for_indexing(client: QdrantClient, expected_points: int, timeout: int = INGEST_BARRIER_TIMEOUT):
+    """Barrera final: las escrituras se hicieron con wait=False, se espera a que Qdrant las haya aplicado todas."""
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        points = client.count(collection_name=QDRANT_COLLECTION_NAME, exact=True).count
+        status = client.get_collection(collection_name=QDRANT_COLLECTION_NAME).status
+        if points == expected_points and status == models.CollectionStatus.GREEN:
+            print(f"Qdrant ha aplicado todos los cambios: {points} puntos.")
+            return True
+        print(f"Esperando a Qdrant: {points}/{expected_points} puntos, estado '{status}'...")
+        time.sleep(2)
+    print(f"Error: Qdrant no ha aplicado todos los cambios tras {timeout} segundos.")
+    return False
+
+def build_points(batch_chunks: list, embeddings: list) -> list:
+    return [
+        models.PointStruct(
+            # COMENTARIO: Id determinista derivado del contenido: el mismo chunk siempre es el mismo punto
+            id=chunk_point_id(chunk_data),
+            vector=embeddings[j],
+            payload={
+                "original_chunk": chunk_data["original_chunk"],
+                "generated_context": chunk_data["generated_context"],
+                "parent_doc_index": chunk_data["parent_doc_index"],
+                # Añadimos la clave 'source' al payload, leyéndola del chunk
+                "source": chunk_data["source"] 
+            }
+        ) for j, chunk_data in enumerate(batch_chunks)
+    ]
+
+def upsert_chunks(client: QdrantClient, chunks: Iterable[dict], embeddings_model: OllamaEmbeddings) -> int:
+    """
+    Genera embeddings y sube los chunks con un pipeline productor/consumidor:
+    INGEST_EMBED_WORKERS hilos piden embeddings en paralelo (como mucho INGEST_MAX_IN_FLIGHT lotes
+    pendientes) y el hilo principal sube cada lote terminado con wait=False.
+    Los lotes se leen de 'chunks' a medida que hay hueco, así que la memoria no depende del tamaño del corpus.
+    Devuelve el número de chunks subidos.
+    """
+    chunks = iter(chunks)
+    pending = iter(lambda: list(islice(chunks, INGEST_BATCH_SIZE)), [])
+
+    def embed_batch(batch_chunks: list):
         texts_to_embed = [chunk['contextualized_chunk'] for chunk in batch_chunks]
-        
-        print(f"Procesando lote {i//batch_size + 1}/{(total_chunks + batch_size - 1)//batch_size}...")
-        embeddings = embeddings_model.embed_documents(texts_to_embed)
-        
-        points_to_upload = [
-            models.PointStruct(
-                id=i+j,
-                vector=embeddings[j],
-                payload={
-                    "original_chunk": chunk_data["original_chunk"],
-                    "generated_context": chunk_data["generated_context"],
-                    "parent_doc_index": chunk_data["parent_doc_index"],
-                    # --- LÍNEA AÑADIDA ---
-                    # Añadimos la clave 'source' al payload, leyéndola del chunk
-                    "source": chunk_data["source"] 
-                }
-            ) for j, chunk_data in enumerate(batch_chunks)
-        ]
-        
-        client.upsert(
+        return batch_chunks, embeddings_model.embed_documents(texts_to_embed)
+
+    start_time = time.time()
+    processed_chunks = processed_batches = 0
+    with ThreadPoolExecutor(max_workers=INGEST_EMBED_WORKERS) as pool:
+        in_flight = set()
+
+        def submit_next():
+            batch_chunks = next(pending, None)
+            if batch_chunks is not None:
+                in_flight.add(pool.submit(embed_batch, batch_chunks))
+
+        for _ in range(INGEST_MAX_IN_FLIGHT):
+            submit_next()
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight.remove(future)
+                batch_chunks, embeddings = future.result()
+                # COMENTARIO: wait=False: Qdrant confirma al recibir el lote y lo aplica en segundo plano
+                client.upsert(
+                    collection_name=QDRANT_COLLECTION_NAME,
+                    points=build_points(batch_chunks, embeddings),
+                    wait=False
+                )
+                submit_next()
+
+                processed_batches += 1
+                processed_chunks += len(batch_chunks)
+                elapsed = time.time() - start_time
+                print(f"Lote {processed_batches} subido "
+                      f"({processed_chunks} chunks en {elapsed:.1f}s, {processed_chunks / elapsed:.1f} chunks/s)")
+    return processed_chunks
+
+def new_chunks(chunks: Iterable[dict], existing: dict, desired: set) -> Iterator[dict]:
+    """Chunks cuyo id aún no está en Qdrant (sin repetir); 'desired' acumula los ids de todo el corpus."""
+    for chunk in chunks:
+        point_id = chunk_point_id(chunk)
+        if point_id in desired:
+            continue
+        desired.add(point_id)
+        if point_id not in existing:
+            yield chunk
+
+def index_in_qdrant(client: QdrantClient, chunks: Iterable[dict], embeddings_model: OllamaEmbeddings) -> bool:
+    """
+    Sincroniza la colección con el corpus: compara los ids deterministas de los chunks con los puntos
+    que ya hay en Qdrant, embebe y sube solo los chunks nuevos o modificados y borra los que ya no
+    existen. Si una ejecución se interrumpe, la siguiente solo completa lo que falte.
+    Los chunks se recorren una sola vez; devuelve False (sin tocar la colección) si no hay ninguno.
+    """
+    print("\nSincronizando la colección de Qdrant...")
+    ensure_collection(client)
+
+    # Un chunk modificado tiene otro id: se sube como nuevo y su versión anterior se borra.
+    existing = fetch_point_ids(client)
+    desired = set()
+    upserted = upsert_chunks(client, new_chunks(chunks, existing, desired), embeddings_model)
+    if not desired:
+        return False
+    to_delete = [point_id for key, point_id in existing.items() if key not in desired]
+    print(f"Chunks en el corpus: {len(desired)}; ya indexados: {len(desired) - upserted}; "
+          f"indexados ahora: {upserted}; a borrar: {len(to_delete)}.")
+
+    for start in range(0, len(to_delete), INGEST_BATCH_SIZE):
+        client.delete(
             collection_name=QDRANT_COLLECTION_NAME,
-            points=points_to_upload,
-            wait=True
+            points_selector=models.PointIdsList(points=to_delete[start:start+INGEST_BATCH_SIZE]),
+            wait=False
         )
+
+    if not wait_for_indexing(client, len(desired)):
+        sys.exit(1)
     print("\n¡Indexación en Qdrant completada con éxito!")
+    return True
 
 if __name__ == "__main__":
     print("--- Proceso de Ingesta de Datos ---")
@@ -159,23 +300,28 @@ if __name__ == "__main__":
     if not wait_for_qdrant(qdrant_client):
         sys.exit(1) # Termina si Qdrant no está disponible
 
-    # Comprueba si los datos ya existen
-    if check_if_data_exists(qdrant_client):
-        print("Saltando el proceso de ingesta.")
-        sys.exit(0) # Termina el script con éxito
-    
-    print("\nLa base de datos está vacía. Iniciando el proceso de ingesta completo.")
-    
-    all_chunks = load_chunks_from_json(INPUT_JSON_FILE)
-    if all_chunks:
-        create_bm25_index(all_chunks)
-        
-        print(f"\nInicializando modelo de embeddings '{OLLAMA_EMBEDDING_MODEL}'...")
-        ollama_embeddings = OllamaEmbeddings(
-            base_url=OLLAMA_BASE_URL,
-            model=OLLAMA_EMBEDDING_MODEL
-        )
-        
-        index_in_qdrant(qdrant_client, all_chunks, ollama_embeddings)
+    print(f"\nInicializando modelo de embeddings '{OLLAMA_EMBEDDING_MODEL}'...")
+    ollama_embeddings = OllamaEmbeddings(
+        base_url=OLLAMA_BASE_URL,
+        model=OLLAMA_EMBEDDING_MODEL
+    )
+    if INGEST_EMBEDDING_CACHE_DIR:
+        embedding_store = MmapEmbeddingStore(INGEST_EMBEDDING_CACHE_DIR, OLLAMA_EMBEDDING_MODEL,
+                                             dtype=INGEST_EMBEDDING_CACHE_DTYPE)
+        print(f"Caché de embeddings en '{embedding_store.directory}' con {len(embedding_store)} vectores.")
+        ollama_embeddings = CachedDocumentEmbeddings(ollama_embeddings, embedding_store)
+
+    # COMENTARIO: La ingesta es incremental: en cada ejecución solo se procesa lo que ha cambiado en el corpus
+    # COMENTARIO: El fichero se lee en streaming y una sola vez: cada chunk alimenta a la vez el almacén,
+    # el índice BM25 y el pipeline de embeddings, sin cargar el corpus entero en memoria
+    print(f"Leyendo chunks desde '{INPUT_JSON_FILE}'...")
+    store_writer, bm25_builder = ChunkStoreWriter(), BM25Builder()
+    chunks = feed_local_indexes(iter_chunks(INPUT_JSON_FILE), store_writer, bm25_builder)
+    if index_in_qdrant(qdrant_client, chunks, ollama_embeddings):
+        sync_chunk_store(store_writer)
+        sync_bm25_index(bm25_builder, store_writer.corpus_hash)
+        if INGEST_EMBEDDING_CACHE_DIR:
+            print(f"Embeddings desde la caché: {ollama_embeddings.hits}; calculados con Ollama: {ollama_embeddings.misses}.")
     else:
-        print("No se encontraron chunks para procesar.")
\ No newline at end of file
+        print("No se encontraron chunks para procesar.")
+    store_writer.close()
@@ -1,15 +1,21 @@
 # main.py
 
+import asyncio
+import json
 import uuid
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from pydantic import BaseModel, Field
 from typing import Optional
 
 # Se importa el constructor del grafo desde tu módulo
 from graph.builder import build_sequential_graph
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk
 import logging
 from fastapi import HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from graph.config import CORPUS_RELOAD_INTERVAL, resources, io_executor, limiters, watch_corpus
+from graph.admission import OverloadedError
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -17,7 +23,19 @@ logger = logging.getLogger(__name__)
 
 # --- 1. Inicialización de la Aplicación y el Grafo ---
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # COMENTARIO: asyncio.to_thread y los pasos síncronos que LangGraph delega en hilos usan el ejecutor
+    # por defecto del event loop; se sustituye por uno de tamaño fijo (IO_WORKERS).
+    asyncio.get_running_loop().set_default_executor(io_executor)
+    # COMENTARIO: Si la ingesta publica otro corpus mientras el backend está en marcha, se recarga sin reiniciar.
+    watcher = asyncio.create_task(watch_corpus()) if CORPUS_RELOAD_INTERVAL > 0 else None
+    yield
+    if watcher is not None:
+        watcher.cancel()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Chatbot RAG API",
     description="Una API para interactuar con un chatbot RAG conversacional usando LangGraph.",
     version="1.0.0",
@@ -108,12 +126,98 @@ async def chat_endpoint(request: ChatRequest):
             conversation_id=conv_id
         )
         
+    except OverloadedError as e:
+        # COMENTARIO: Sobrecarga: respuesta rápida con Retry-After en lugar de un timeout
+        logger.warning(f"Overloaded: {str(e)}")
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _ndjson(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Igual que /chat, pero devuelve la respuesta token a token como NDJSON (una línea JSON por evento):
+      {"type": "token", "content": "..."}  por cada fragmento generado,
+      {"type": "end", "assistant_response": "...", "conversation_id": "..."}  al terminar,
+      {"type": "error", "detail": "..."}  si falla a mitad del stream (con status_code y retry_after si es por sobrecarga).
+    El ID de la conversación también se envía en la cabecera X-Conversation-Id.
+    """
+    logger.info(f"Received stream request: {request.user_input}")
+    # COMENTARIO: Si la cola del generador ya está llena se rechaza antes de empezar el stream,
+    # mientras todavía se puede devolver un código HTTP.
+    try:
+        limiters["generator"].check()
+    except OverloadedError as e:
+        logger.warning(f"Overloaded: {str(e)}")
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    conv_id = request.conversation_id or str(uuid.uuid4())
+    config = {"configurable": {"thread_id": conv_id}}
+    input_data = {"messages": [HumanMessage(content=request.user_input)]}
+
+    async def event_stream():
+        streamed = False
+        final_state = None
+        try:
+            # COMENTARIO: "messages" trae los tokens del LLM y "values" el estado final, necesario cuando la
+            # respuesta no pasa por el generador (caché de respuestas o sin documentos).
+            async for mode, payload in langgraph_app.astream(input_data, config, stream_mode=["messages", "values"]):
+                if mode == "messages":
+                    chunk, metadata = payload
+                    # Solo los tokens del generador (el router también usa un LLM)
+                    if isinstance(chunk, AIMessageChunk) and metadata.get("langgraph_node") == "generator" and chunk.content:
+                        streamed = True
+                        yield _ndjson({"type": "token", "content": chunk.content})
+                else:
+                    final_state = payload
+
+            response_content = final_state["messages"][-1].content
+            if not streamed:
+                yield _ndjson({"type": "token", "content": response_content})
+            yield _ndjson({"type": "end", "assistant_response": response_content, "conversation_id": conv_id})
+        except OverloadedError as e:
+            logger.warning(f"Overloaded: {str(e)}")
+            yield _ndjson({"type": "error", "detail": str(e), "status_code": e.status_code, "retry_after": e.retry_after})
+        except Exception as e:
+            # Los errores no pueden ser un 500 porque la respuesta ya ha empezado
+            logger.error(f"Error in chat stream endpoint: {str(e)}")
+            yield _ndjson({"type": "error", "detail": str(e)})
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson",
+                             headers={"X-Conversation-Id": conv_id})
+
 @app.get("/")
 def read_root():
     return {"status": "Chatbot RAG API is running"}
 
+@app.get("/ready")
+def readiness():
+    """
+    Indica si todos los recursos (índices, clientes y reranker) están cargados.
+    Devuelve 503 mientras alguno siga cargando o haya fallado, con el estado y el tiempo de cada uno.
+    """
+    ready = resources.is_ready()
+    body = {"ready": ready, "resources": resources.status()}
+    return JSONResponse(content=body, status_code=200 if ready else 503)
+
+@app.get("/stats")
+def stats():
+    """Contadores de las cachés del backend (solo de los recursos ya cargados) y del control de admisión."""
+    body = {"admission": {name: limiter.stats() for name, limiter in limiters.items()}}
+    body["memory"] = langgraph_app.checkpointer.stats()
+    if resources["ollama_embeddings"].state == "ready":
+        body["embedding_cache"] = resources.get("ollama_embeddings").stats()
+    if resources["router"].state == "ready":
+        body["router"] = resources.get("router").stats()
+    if resources["reranker"].state == "ready":
+        body["reranker"] = resources.get("reranker").stats()
+    if resources["rerank_cache"].state == "ready":
+        body["rerank_cache"] = resources.get("rerank_cache").stats()
+    if resources["answer_cache"].state == "ready":
+        body["answer_cache"] = resources.get("answer_cache").stats()
+    return body
+
 #uvicorn main:app --reload
\ No newline at end of file